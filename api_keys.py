@@ -0,0 +1,185 @@
+import json
+import math
+import time
+import hmac
+import hashlib
+import logging
+import threading
+from typing import Optional, Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+# Имя ключа API_TOKEN; зарезервировано, так как по имени ключа определяется владелец заданий
+DEFAULT_KEY_NAME = 'default'
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: rate токенов в секунду, емкость burst"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """Взять один токен. Возвращает 0 при успехе, иначе сколько секунд ждать"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+class ApiKey:
+    """API ключ клиента со своей квотой запросов, лимитом параллельности и счетчиками"""
+
+    def __init__(self, name: str, token: str, rate: Optional[float] = None, burst: Optional[float] = None,
+                 max_concurrent: Optional[int] = None, admin: bool = False):
+        self.name = name
+        self.digest = hashlib.sha256(token.encode()).digest()
+        self.admin = admin
+        if rate is not None:
+            burst = max(1.0, rate) if burst is None else burst
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+        self.max_concurrent = max_concurrent
+        self._slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent is not None else None
+        self._lock = threading.Lock()
+        self.counters = {
+            'requests': 0,
+            'rejected_rate': 0,
+            'rejected_concurrency': 0,
+            'in_flight': 0,
+        }
+
+    def _count(self, key: str, delta: int = 1):
+        with self._lock:
+            self.counters[key] += delta
+
+    def admit(self) -> Optional[float]:
+        """Проверить квоту и занять слот параллельности.
+
+        Возвращает None если запрос допущен (тогда обязательно вызвать release),
+        иначе число секунд для заголовка Retry-After.
+        """
+        if self._slots and not self._slots.acquire(blocking=False):
+            self._count('rejected_concurrency')
+            return 1.0
+        if self.bucket:
+            wait = self.bucket.try_acquire()
+            if wait:
+                if self._slots:
+                    self._slots.release()
+                self._count('rejected_rate')
+                return wait
+        with self._lock:
+            self.counters['requests'] += 1
+            self.counters['in_flight'] += 1
+        return None
+
+    def release(self):
+        self._count('in_flight', -1)
+        if self._slots:
+            self._slots.release()
+
+    def usage(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            'name': self.name,
+            'admin': self.admin,
+            'rate': self.bucket.rate if self.bucket else None,
+            'burst': self.bucket.burst if self.bucket else None,
+            'max_concurrent': self.max_concurrent,
+            **counters,
+        }
+
+
+class ApiKeyRegistry:
+    """Набор API ключей: основной API_TOKEN плюс ключи из файла API_KEYS_FILE.
+
+    Формат файла - JSON список объектов:
+    [{"name": "alerts", "token": "...", "rate": 20, "burst": 40, "max_concurrent": 8, "admin": false}]
+    rate - запросов в секунду, burst - емкость bucket, max_concurrent - одновременных запросов.
+    Пропущенные лимиты означают отсутствие ограничения; заданные должны быть положительными.
+    """
+
+    def __init__(self, default_token: str, keys_file: Optional[str] = None):
+        self._keys: Dict[bytes, ApiKey] = {}
+        self._add(ApiKey(DEFAULT_KEY_NAME, default_token, admin=True))
+        if keys_file:
+            self._load(keys_file)
+
+    @staticmethod
+    def _validate(entry: Any) -> Dict[str, Any]:
+        """Проверить запись файла ключей, ValueError с понятным сообщением при ошибке"""
+        if not isinstance(entry, dict):
+            raise ValueError('API key entry must be an object')
+        name = entry.get('name')
+        if not isinstance(name, str) or not name:
+            raise ValueError('API key entry requires a non-empty "name"')
+        if name == DEFAULT_KEY_NAME:
+            raise ValueError(f"API key name '{DEFAULT_KEY_NAME}' is reserved for API_TOKEN")
+        if not isinstance(entry.get('token'), str) or not entry['token']:
+            raise ValueError(f"API key '{name}' requires a non-empty \"token\"")
+        for field in ('rate', 'burst'):
+            value = entry.get(field)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))
+                                      or not math.isfinite(value) or value <= 0):
+                raise ValueError(f"API key '{name}': {field} must be a positive number")
+        if entry.get('burst') is not None:
+            if entry.get('rate') is None:
+                raise ValueError(f"API key '{name}': burst requires rate")
+            if entry['burst'] < 1:
+                raise ValueError(f"API key '{name}': burst must be at least 1")
+        max_concurrent = entry.get('max_concurrent')
+        if max_concurrent is not None and (isinstance(max_concurrent, bool) or not isinstance(max_concurrent, int)
+                                           or max_concurrent <= 0):
+            raise ValueError(f"API key '{name}': max_concurrent must be a positive integer")
+        if not isinstance(entry.get('admin', False), bool):
+            raise ValueError(f"API key '{name}': admin must be true or false")
+        return entry
+
+    def _add(self, key: ApiKey):
+        if any(existing.name == key.name for existing in self._keys.values()):
+            raise ValueError(f"Duplicate API key name '{key.name}'")
+        if key.digest in self._keys:
+            raise ValueError(f"Duplicate API token for key '{key.name}'")
+        self._keys[key.digest] = key
+
+    def _load(self, keys_file: str):
+        with open(keys_file, encoding='utf-8') as f:
+            entries = json.load(f)
+        if not isinstance(entries, list):
+            raise ValueError(f"{keys_file} must contain a JSON list of API keys")
+        for entry in map(self._validate, entries):
+            self._add(ApiKey(
+                name=entry['name'],
+                token=entry['token'],
+                rate=entry.get('rate'),
+                burst=entry.get('burst'),
+                max_concurrent=entry.get('max_concurrent'),
+                admin=entry.get('admin', False),
+            ))
+        logger.info(f"Загружено {len(entries)} API ключей из {keys_file}")
+
+    def authenticate(self, authorization: Optional[str]) -> Optional[ApiKey]:
+        """Найти ключ по заголовку Authorization: Bearer <token>.
+
+        Поиск идет по SHA-256 токена, а итоговое сравнение дайджестов -
+        через hmac.compare_digest, поэтому время ответа не зависит от совпадения префикса.
+        """
+        if not authorization or not authorization.startswith('Bearer '):
+            return None
+        digest = hashlib.sha256(authorization[len('Bearer '):].encode()).digest()
+        key = self._keys.get(digest)
+        if key is None or not hmac.compare_digest(key.digest, digest):
+            return None
+        return key
+
+    def usage(self) -> List[Dict[str, Any]]:
+        return [key.usage() for key in self._keys.values()]
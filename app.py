@@ -1,13 +1,15 @@
+import atexit
 import asyncio
 import logging
-from telegram import Update, Bot
+from telegram import Update, Bot, User, InlineQueryResultArticle, InputTextMessageContent
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
-from telegram.ext import Application
+from telegram.ext import Application, TypeHandler, InlineQueryHandler
 import os
 from typing import Dict, Any, Optional
 import json
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context
 import threading
 import secrets
 import base64
@@ -15,6 +17,16 @@ from io import BytesIO
 import time
 import concurrent.futures
 from proxy_config import proxy_config
+from scheduler import message_scheduler, parse_send_time
+from api_keys import ApiKeyRegistry
+from circuit_breaker import circuit_breakers, CircuitOpenError
+from deadline import (DEFAULT_TIMEOUT, MIN_BUDGET, DeadlineExceeded, ClientDisconnected, parse_deadline,
+                      remaining, ensure_budget, cap_timeout, client_disconnected)
+from shared_files import shared_files, detect_file_type, MultipartFileStream, StreamingInputFile
+from update_backlog import update_backlog, TRACK_GROUP
+from inline_cache import inline_results_cache, known_entities, INLINE_CACHE_TIME
+from traffic_capture import traffic_recorder
+from coalescer import MessageCoalescer, TELEGRAM_TEXT_LIMIT, DISCORD_TEXT_LIMIT
 try:
     from aiohttp_socks import SocksConnector
 except ImportError:
@@ -30,6 +42,10 @@ logger = logging.getLogger(__name__)
 APP_VERSION = "2.2.2-proxy"
 logger.info(f"=============== App Version: {APP_VERSION} ===============")
 
+# Альтернативные адреса API (локальный Bot API сервер или заглушки replay.py)
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', '').strip()
+DISCORD_API_BASE_URL = os.getenv('DISCORD_API_BASE_URL', '').strip().rstrip('/')
+
 class UserInfoBot:
     def __init__(self, token: str):
         self.token = token
@@ -50,7 +66,11 @@ class UserInfoBot:
                 'channel_username': 'Username: @{username}',
                 'message_link': 'Message Link: https://t.me/{username}/{message_id}',
                 'not_forwarded': 'This message was not forwarded. Showing sender info instead.',
-                'no_user_info': 'No user information found in the forwarded message.'
+                'no_user_info': 'No user information found in the forwarded message.',
+                'user_info': 'User Info:',
+                'your_info': 'Your User Info:',
+                'inline_own_title': 'Your ID: {id}',
+                'inline_entity_title': '@{username} ID: {id}'
             },
             'ru': {
                 'forwarded_user_info': 'Информация о пересланном пользователе:',
@@ -64,7 +84,11 @@ class UserInfoBot:
                 'channel_username': 'Имя пользователя: @{username}',
                 'message_link': 'Ссылка на сообщение: https://t.me/{username}/{message_id}',
                 'not_forwarded': 'Это сообщение не было переслано. Показана информация об отправителе.',
-                'no_user_info': 'В пересланном сообщении не найдена информация о пользователе.'
+                'no_user_info': 'В пересланном сообщении не найдена информация о пользователе.',
+                'user_info': 'Информация о пользователе:',
+                'your_info': 'Информация о вас:',
+                'inline_own_title': 'Ваш ID: {id}',
+                'inline_entity_title': '@{username} ID: {id}'
             }
         }
 
@@ -109,6 +133,35 @@ class UserInfoBot:
         )
         await update.message.reply_text(welcome_text)
 
+    def format_user_fields(self, user, lang: str) -> str:
+        """Строки с информацией о пользователе (username, ID, имя, язык)"""
+        response_text = ""
+        
+        if user.username:
+            response_text += self.get_text('username', lang).format(username=user.username) + "\n"
+        
+        response_text += self.get_text('id', lang).format(id=user.id) + "\n"
+        response_text += self.get_text('first_name', lang).format(first_name=user.first_name) + "\n"
+        
+        if user.last_name:
+            response_text += self.get_text('last_name', lang).format(last_name=user.last_name) + "\n"
+        
+        if user.language_code:
+            response_text += self.get_text('language_code', lang).format(language_code=user.language_code) + "\n"
+        
+        return response_text
+
+    def format_channel_fields(self, channel, lang: str) -> str:
+        """Строки с информацией о канале (username, ID, название)"""
+        response_text = ""
+        
+        if channel.username:
+            response_text += self.get_text('channel_username', lang).format(username=channel.username) + "\n"
+        
+        response_text += self.get_text('id', lang).format(id=channel.id) + "\n"
+        response_text += self.get_text('title', lang).format(title=channel.title) + "\n"
+        return response_text
+
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle incoming messages and extract user info from forwarded messages."""
         if not update.message:
@@ -117,22 +170,16 @@ class UserInfoBot:
         message = update.message
         lang = update.effective_user.language_code if update.effective_user and update.effective_user.language_code else 'en'
         
+        # Запомнить увиденных пользователей и каналы для поиска в inline режиме
+        for entity in (message.from_user, message.forward_from, message.forward_from_chat):
+            if entity:
+                known_entities.remember(entity)
+        
         # Check if the message is forwarded from a user
         if message.forward_from:
             user = message.forward_from
             response_text = self.get_text('forwarded_user_info', lang) + "\n"
-            
-            if user.username:
-                response_text += self.get_text('username', lang).format(username=user.username) + "\n"
-            
-            response_text += self.get_text('id', lang).format(id=user.id) + "\n"
-            response_text += self.get_text('first_name', lang).format(first_name=user.first_name) + "\n"
-            
-            if user.last_name:
-                response_text += self.get_text('last_name', lang).format(last_name=user.last_name) + "\n"
-            
-            if user.language_code:
-                response_text += self.get_text('language_code', lang).format(language_code=user.language_code) + "\n"
+            response_text += self.format_user_fields(user, lang)
             
             await message.reply_text(response_text.strip())
 
@@ -140,12 +187,7 @@ class UserInfoBot:
         elif message.forward_from_chat:
             channel = message.forward_from_chat
             response_text = self.get_text('channel_info', lang) + "\n"
-            
-            if channel.username:
-                response_text += self.get_text('channel_username', lang).format(username=channel.username) + "\n"
-            
-            response_text += self.get_text('id', lang).format(id=channel.id) + "\n"
-            response_text += self.get_text('title', lang).format(title=channel.title) + "\n"
+            response_text += self.format_channel_fields(channel, lang)
             
             if message.forward_from_message_id and channel.username:
                 response_text += self.get_text('message_link', lang).format(
@@ -159,21 +201,55 @@ class UserInfoBot:
         else:
             user = message.from_user
             response_text = self.get_text('not_forwarded', lang) + "\n\n"
-            
-            if user.username:
-                response_text += self.get_text('username', lang).format(username=user.username) + "\n"
-            
-            response_text += self.get_text('id', lang).format(id=user.id) + "\n"
-            response_text += self.get_text('first_name', lang).format(first_name=user.first_name) + "\n"
-            
-            if user.last_name:
-                response_text += self.get_text('last_name', lang).format(last_name=user.last_name) + "\n"
-            
-            if user.language_code:
-                response_text += self.get_text('language_code', lang).format(language_code=user.language_code) + "\n"
+            response_text += self.format_user_fields(user, lang)
             
             await message.reply_text(response_text.strip())
 
+    def build_inline_results(self, user, query: str, lang: str) -> list:
+        """Карточка вызывающего и, если запрошен известный @username, карточка этой сущности"""
+        own_text = self.get_text('your_info', lang) + "\n" + self.format_user_fields(user, lang)
+        results = [InlineQueryResultArticle(
+            id=f"self-{user.id}",
+            title=self.get_text('inline_own_title', lang).format(id=user.id),
+            description=own_text.strip().replace("\n", " | "),
+            input_message_content=InputTextMessageContent(own_text.strip()),
+        )]
+        
+        entity = known_entities.find(query) if query else None
+        if entity is not None and entity.id != user.id:
+            if isinstance(entity, User):
+                entity_text = self.get_text('user_info', lang) + "\n" + self.format_user_fields(entity, lang)
+            else:
+                entity_text = self.get_text('channel_info', lang) + "\n" + self.format_channel_fields(entity, lang)
+            results.insert(0, InlineQueryResultArticle(
+                id=f"entity-{entity.id}",
+                title=self.get_text('inline_entity_title', lang).format(username=entity.username, id=entity.id),
+                description=entity_text.strip().replace("\n", " | "),
+                input_message_content=InputTextMessageContent(entity_text.strip()),
+            ))
+        return results
+
+    async def handle_inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Ответить на inline запрос (@bot в любом чате) карточкой с ID"""
+        inline_query = update.inline_query
+        if not inline_query:
+            return
+        
+        user = inline_query.from_user
+        lang = user.language_code if user.language_code else 'en'
+        query = inline_query.query.strip().split()[0].lstrip('@').lower() if inline_query.query.strip() else ''
+        known_entities.remember(user)
+        
+        # Отрисованные результаты кэшируются по пользователю, языку и запросу
+        cache_key = (user.id, lang, query)
+        results = inline_results_cache.get(cache_key)
+        if results is None:
+            results = self.build_inline_results(user, query, lang)
+            inline_results_cache.set(cache_key, results)
+        
+        # is_personal: ответ зависит от вызывающего, cache_time: Telegram отвечает из своего кэша
+        await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Log the error and send a telegram message to notify the developer."""
         logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -188,12 +264,14 @@ class UserInfoBot:
         result = await self.bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, **kwargs)
         return result
 
-    async def send_media(self, chat_id: str, text: str = None, image_url: str = None, **kwargs):
+    async def send_media(self, chat_id: str, text: str = None, image_url: str = None,
+                         file_path: str = None, file_type: str = 'document', **kwargs):
         """Универсальный метод для отправки текста или фото с подписью.
         image_url может быть:
         - URL адресом (https://...)
         - base64 строкой (data:image/...;base64,...)
         - просто base64 данными
+        file_path - проверенный путь к файлу на общем томе, file_type - 'photo' или 'document'
         """
         logger.info(f"Отправка сообщения в чат {chat_id}: {'через прокси' if proxy_config.is_telegram_proxy_enabled() else 'без прокси'}")
         logger.warning(f">>> send_media CALLED: chat_id={chat_id}, text={text is not None}, image_url={image_url is not None}")
@@ -201,7 +279,17 @@ class UserInfoBot:
             logger.warning(f">>> image_url type: {type(image_url)}, length: {len(image_url) if image_url else 0}, first 100 chars: {image_url[:100] if image_url else 'NONE'}")
         
         try:
-            if image_url:
+            if file_path:
+                # Файл передается в multipart потоком, без чтения в память
+                logger.info(f"Sending {file_type} from shared volume: {file_path}, size: {os.path.getsize(file_path)} bytes")
+                with open(file_path, 'rb') as f:
+                    upload = StreamingInputFile(f, filename=os.path.basename(file_path))
+                    if file_type == 'photo':
+                        result = await self.bot.send_photo(chat_id=chat_id, photo=upload, caption=text, **kwargs)
+                    else:
+                        result = await self.bot.send_document(chat_id=chat_id, document=upload, caption=text, **kwargs)
+                logger.info(f"File sent successfully, message_id: {result.message_id}")
+            elif image_url:
                 logger.warning(f">>> SENDING PHOTO! image_url={image_url[:100]}")
                 
                 # Проверить если это base64
@@ -250,6 +338,8 @@ class UserInfoBot:
         if not self.application:
             # Создать Application с поддержкой SOCKS прокси
             builder = Application.builder().token(self.token)
+            if TELEGRAM_API_BASE_URL:
+                builder = builder.base_url(TELEGRAM_API_BASE_URL)
             
             # Если Telegram прокси включен, попытаться использовать его
             if proxy_config.is_telegram_proxy_enabled():
@@ -270,6 +360,7 @@ class UserInfoBot:
             # Add handlers
             self.application.add_handler(CommandHandler("start", self.start))
             self.application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, self.handle_message))
+            self.application.add_handler(InlineQueryHandler(self.handle_inline_query))
             
             # Add error handler
             self.application.add_error_handler(self.error_handler)
@@ -286,268 +377,529 @@ API_TOKEN = os.getenv('API_TOKEN', secrets.token_urlsafe(32))
 masked_token = f"{API_TOKEN[:4]}...{API_TOKEN[-4:]}" if len(API_TOKEN) > 8 else "***"
 print(f"API Token: {masked_token}")  # Print masked token for user to see
 
+# Дополнительные ключи клиентов с собственными квотами (см. api_keys.py)
+api_keys = ApiKeyRegistry(API_TOKEN, os.getenv('API_KEYS_FILE'))
+
 def require_api_token(f):
-    """Decorator to require API token for authentication."""
+    """Decorator to require API token for authentication and enforce the key's quota."""
     def decorated_function(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if not token or token != f"Bearer {API_TOKEN}":
+        key = api_keys.authenticate(request.headers.get('Authorization'))
+        if key is None:
             return jsonify({'error': 'Invalid or missing API token'}), 401
-        return f(*args, **kwargs)
+        # Квота проверяется до разбора тела запроса и любой загрузки/декодирования
+        retry_after = key.admit()
+        if retry_after is not None:
+            response = jsonify({'error': f"Rate limit exceeded for API key '{key.name}'"})
+            response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+            return response, 429
+        g.api_key = key
+        try:
+            return f(*args, **kwargs)
+        finally:
+            key.release()
     decorated_function.__name__ = f.__name__
     return decorated_function
 
-# Define API endpoints
-@app.route('/send_message', methods=['POST'])
-@require_api_token
-def send_message_api():
-    data = request.get_json()
-    chat_id = data.get('chat_id') if data else None
-    text = data.get('text') if data else None
-    image_url = data.get('image_url') if data else None  # URL, file_id, или base64 строка
-    
-    logger.info(f"send_message_api called: chat_id={chat_id}, has_text={bool(text)}, has_image_url={bool(image_url)}")
-    
-    if not chat_id or (not text and not image_url):
-        return jsonify({'error': 'chat_id and either text or image_url are required. image_url может быть URL, file_id или base64'}), 400
-    
-    # Check if it's a Discord webhook URL
-    if chat_id.startswith('https://discord.com/api/webhooks/'):
+def capture_traffic(endpoint: str, target_field: str):
+    """Decorator to record the sanitized shape and timing of send requests when capture is enabled."""
+    def decorator(f):
+        def decorated_function(*args, **kwargs):
+            if not traffic_recorder.is_enabled():
+                return f(*args, **kwargs)
+            started = time.time()
+            response = app.make_response(f(*args, **kwargs))
+            # Тело разбирается только у запросов, прошедших аутентификацию и квоту
+            data = request.get_json(silent=True) if response.status_code not in (401, 429) else None
+            record = {'ts': round(started, 3), **traffic_recorder.describe(endpoint, data, target_field,
+                                                                            request.headers, started)}
+            if record['img'] == 'file':
+                try:
+                    record['img_b'] = os.path.getsize(shared_files.resolve(data['file_path']))
+                except (ValueError, OSError):
+                    pass
+            api_key = g.get('api_key')
+            record['key'] = api_key.name if api_key else None
+            record['st'] = response.status_code
+            record['ms'] = round((time.time() - started) * 1000, 1)
+            traffic_recorder.write(record)
+            return response
+        decorated_function.__name__ = f.__name__
+        return decorated_function
+    return decorator
+
+def require_admin_token(f):
+    """Decorator to restrict an endpoint to admin API keys."""
+    def decorated_function(*args, **kwargs):
+        if not g.api_key.admin:
+            return jsonify({'error': 'Admin API key required'}), 403
+        return f(*args, **kwargs)
+    decorated_function.__name__ = f.__name__
+    return require_api_token(decorated_function)
+
+DISCORD_WEBHOOK_PREFIX = 'https://discord.com/api/webhooks/'
+
+
+def is_discord_webhook(target: str) -> bool:
+    """Проверить, является ли получатель URL Discord webhook"""
+    return target.startswith(DISCORD_WEBHOOK_PREFIX)
+
+
+# Таймаут запросов к Discord webhook, чтобы мертвый webhook не держал Flask worker
+DISCORD_TIMEOUT = float(os.getenv('DISCORD_TIMEOUT', '15'))
+# HTTP статусы, после которых webhook считается недоступным надолго
+PERMANENT_HTTP_STATUSES = (401, 403, 404)
+
+
+def load_discord_image(image_url: str, proxies: Optional[Dict[str, str]], deadline: Optional[float] = None):
+    """Получить (данные, имя файла, MIME тип) изображения для загрузки в Discord.
+    image_url может быть URL, data URL или просто base64 данными.
+    """
+    image_data = None
+    image_filename = 'image.jpg'
+    image_mimetype = 'image/jpeg'
+
+    # Определить тип image_url и получить данные
+    if image_url.startswith('data:image/'):
+        # Data URL с base64
+        try:
+            mime_part = image_url.split(';')[0].replace('data:', '')
+            image_mimetype = mime_part
+            if mime_part == 'image/png':
+                image_filename = 'image.png'
+            elif mime_part == 'image/gif':
+                image_filename = 'image.gif'
+            elif mime_part == 'image/webp':
+                image_filename = 'image.webp'
+
+            base64_data = image_url.split(',')[1]
+            image_data = base64.b64decode(base64_data)
+            logger.info(f"Discord: Decoded data URL, size: {len(image_data)} bytes")
+        except Exception as e:
+            logger.error(f"Discord: Error decoding data URL: {e}")
+            raise
+
+    elif not image_url.startswith('http'):
+        # Обычная base64 строка
+        try:
+            image_data = base64.b64decode(image_url)
+            logger.info(f"Discord: Decoded base64 string, size: {len(image_data)} bytes")
+        except Exception as e:
+            logger.error(f"Discord: Error decoding base64: {e}")
+            raise
+
+    else:
+        # Это URL - скачать файл
+        try:
+            ensure_budget(deadline, 'image download')
+            logger.info(f"Discord: Downloading image from URL: {image_url[:100]}")
+            response = requests.get(image_url, timeout=cap_timeout(30, deadline), proxies=proxies)
+            response.raise_for_status()
+            image_data = response.content
+            logger.info(f"Discord: Downloaded image, size: {len(image_data)} bytes")
+
+            # Определить MIME тип из URL если возможно
+            if image_url.lower().endswith('.png'):
+                image_mimetype = 'image/png'
+                image_filename = 'image.png'
+            elif image_url.lower().endswith('.gif'):
+                image_mimetype = 'image/gif'
+                image_filename = 'image.gif'
+            elif image_url.lower().endswith('.webp'):
+                image_mimetype = 'image/webp'
+                image_filename = 'image.webp'
+        except Exception as e:
+            logger.error(f"Discord: Error downloading image from URL: {e}")
+            raise
+
+    return image_data, image_filename, image_mimetype
+
+
+def post_discord_webhook(webhook_url: str, deadline: Optional[float] = None, **kwargs) -> requests.Response:
+    """POST в Discord webhook с таймаутом; результат учитывается в circuit breaker"""
+    try:
+        ensure_budget(deadline, 'Discord upload')
+        url = webhook_url.replace('https://discord.com', DISCORD_API_BASE_URL, 1) if DISCORD_API_BASE_URL else webhook_url
+        response = requests.post(url, timeout=cap_timeout(DISCORD_TIMEOUT, deadline), **kwargs)
+    except requests.RequestException as e:
+        circuit_breakers.record_failure(webhook_url, permanent=False, reason=type(e).__name__)
+        raise
+    except BaseException:
+        circuit_breakers.release_probe(webhook_url)
+        raise
+
+    if response.status_code in (200, 204):
+        circuit_breakers.record_success(webhook_url)
+    elif response.status_code in PERMANENT_HTTP_STATUSES:
+        circuit_breakers.record_failure(webhook_url, permanent=True, reason=f'HTTP {response.status_code}')
+    elif response.status_code == 429 or response.status_code >= 500:
+        circuit_breakers.record_failure(webhook_url, permanent=False, reason=f'HTTP {response.status_code}')
+    else:
+        # Ошибка в самом запросе (например 400), webhook при этом жив
+        circuit_breakers.release_probe(webhook_url)
+    return response
+
+
+def send_discord_webhook(webhook_url: str, text: str = None, image_url: str = None, wait: bool = False,
+                         deadline: Optional[float] = None, file_path: str = None) -> requests.Response:
+    """Отправить текст или изображение с подписью в Discord webhook.
+    image_url может быть URL, data URL или просто base64 данными.
+    file_path - проверенный путь к файлу на общем томе, отправляется потоком.
+    wait=True просит Discord вернуть созданное сообщение (с id) вместо 204.
+    Выбрасывает CircuitOpenError, если webhook временно отключен,
+    и DeadlineExceeded, если до дедлайна не успеть.
+    """
+    circuit_breakers.check(webhook_url)
+    proxies = proxy_config.get_discord_proxy_dict()
+    params = {'wait': 'true'} if wait else None
+
+    if file_path:
+        # requests собрал бы multipart в памяти, поэтому тело формируется потоком
+        try:
+            body = MultipartFileStream({'content': text} if text else {}, 'file', file_path)
+        except BaseException:
+            circuit_breakers.release_probe(webhook_url)
+            raise
+        logger.info(f"Discord: Streaming file {file_path}, size: {len(body)} bytes")
         try:
+            return post_discord_webhook(webhook_url, deadline, params=params, data=body,
+                                        headers={'Content-Type': body.content_type}, proxies=proxies)
+        finally:
+            body.close()
+
+    if image_url:
+        # Преобразовать image_url в бинарные данные и отправить как multipart/form-data
+        logger.info(f"Discord: Processing image_url for multipart upload")
+        try:
+            image_data, image_filename, image_mimetype = load_discord_image(image_url, proxies, deadline)
+        except BaseException:
+            circuit_breakers.release_probe(webhook_url)
+            raise
+
+        # Отправить в multipart/form-data
+        files = {'file': (image_filename, BytesIO(image_data), image_mimetype)}
+        data = {'content': text} if text else {}
+
+        logger.info(f"Отправка в Discord: {'через прокси' if bool(proxies) else 'без прокси'}")
+        logger.info(f"Discord: Sending image as multipart, filename: {image_filename}, content: {text is not None}")
+        return post_discord_webhook(webhook_url, deadline, params=params, files=files, data=data, proxies=proxies)
+
+    # Только текст
+    payload = {'content': text}
+    logger.info(f"Отправка в Discord: {'через прокси' if bool(proxies) else 'без прокси'}")
+    logger.info(f"Discord: Sending text only")
+    return post_discord_webhook(
+        webhook_url,
+        deadline,
+        params=params,
+        data=json.dumps(payload),
+        headers={'Content-Type': 'application/json'},
+        proxies=proxies
+    )
+
+
+async def send_telegram(chat_id: str, text: str = None, image_url: str = None, deadline: Optional[float] = None,
+                        file_path: str = None, file_type: str = 'document'):
+    """Отправить через send_media с учетом circuit breaker получателя.
+    Выбрасывает CircuitOpenError, если чат временно отключен,
+    и DeadlineExceeded, если до дедлайна не успеть (отправка при этом отменяется).
+    """
+    left = ensure_budget(deadline, 'Telegram send')
+    circuit_breakers.check(chat_id)
+    try:
+        if left is None:
+            result = await user_info_bot.send_media(chat_id, text=text, image_url=image_url,
+                                                    file_path=file_path, file_type=file_type)
+        else:
+            # Таймауты HTTP запроса и сама корутина ограничены оставшимся временем
+            timeouts = {name: left for name in ('connect_timeout', 'read_timeout', 'write_timeout', 'pool_timeout')}
+            try:
+                result = await asyncio.wait_for(
+                    user_info_bot.send_media(chat_id, text=text, image_url=image_url,
+                                             file_path=file_path, file_type=file_type, **timeouts),
+                    timeout=left
+                )
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded('Deadline exceeded during Telegram send')
+    except Forbidden as e:
+        # Бота удалили из чата или пользователь его заблокировал
+        circuit_breakers.record_failure(chat_id, permanent=True, reason=str(e))
+        raise
+    except BadRequest as e:
+        if 'not found' in str(e).lower():
+            circuit_breakers.record_failure(chat_id, permanent=True, reason=str(e))
+        else:
+            circuit_breakers.release_probe(chat_id)
+        raise
+    except (TimedOut, NetworkError, RetryAfter) as e:
+        circuit_breakers.record_failure(chat_id, permanent=False, reason=str(e) or type(e).__name__)
+        raise
+    except BaseException:
+        circuit_breakers.release_probe(chat_id)
+        raise
+    circuit_breakers.record_success(chat_id)
+    return result
+
+
+def deadline_response(e: Exception):
+    """Ответ 504 при истекшем дедлайне или 499 если клиент отключился"""
+    logger.warning(f"Send aborted: {e}")
+    status = 499 if isinstance(e, ClientDisconnected) else 504
+    return jsonify({'error': str(e)}), status
+
+
+def circuit_open_response(e: CircuitOpenError):
+    """Ответ 503 для отключенного получателя"""
+    response = jsonify({'error': str(e), 'circuit': 'open'})
+    response.headers['Retry-After'] = str(int(e.retry_after + 0.999))
+    return response, 503
+
+
+# Как часто Flask поток проверяет, не отключился ли клиент
+DISCONNECT_POLL_INTERVAL = 0.5
+
+
+def run_on_bot_loop(coro, deadline: Optional[float] = None):
+    """Выполнить корутину на event loop telegram потока и дождаться результата.
+
+    Если истек дедлайн или клиент отключился, корутина отменяется на loop,
+    а не продолжает загрузку впустую.
+    """
+    if deadline is None:
+        deadline = time.time() + DEFAULT_TIMEOUT
+    if not (user_info_bot.loop and user_info_bot.loop.is_running()):
+        logger.warning("Event loop not running, using asyncio.run")
+        return asyncio.run(coro)
+
+    logger.info("Using existing event loop from telegram thread")
+    future = asyncio.run_coroutine_threadsafe(coro, user_info_bot.loop)
+    while True:
+        left = remaining(deadline)
+        if left <= 0:
+            future.cancel()
+            raise DeadlineExceeded('Deadline exceeded waiting for send')
+        try:
+            return future.result(timeout=min(DISCONNECT_POLL_INTERVAL, left))
+        except concurrent.futures.TimeoutError:
+            if has_request_context() and client_disconnected(request.environ):
+                future.cancel()
+                raise ClientDisconnected('Client disconnected, send cancelled')
+
+
+async def send_scheduled_message(job: Dict[str, Any]):
+    """Отправить наступившее отложенное сообщение обычным путем (Telegram или Discord)"""
+    target = job['target']
+    if is_discord_webhook(target):
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, lambda: send_discord_webhook(
+            target, text=job.get('text'), image_url=job.get('image_url'), file_path=job.get('file_path')
+        ))
+        if response.status_code == 429 or response.status_code >= 500:
+            raise requests.HTTPError(f'Discord webhook failed: {response.status_code}', response=response)
+        if response.status_code not in (200, 204):
+            raise RuntimeError(f'Discord webhook failed: {response.status_code} - {response.text}')
+        return response
+    return await send_telegram(target, text=job.get('text'), image_url=job.get('image_url'),
+                               file_path=job.get('file_path'), file_type=job.get('file_type') or 'document')
+
+
+def is_retryable_send_error(e: Exception) -> bool:
+    """Стоит ли повторить отложенное сообщение позже: временные ошибки сети и API"""
+    if isinstance(e, (BadRequest, Forbidden)):
+        return False
+    return isinstance(e, (CircuitOpenError, DeadlineExceeded, TimedOut, NetworkError, RetryAfter,
+                          requests.RequestException))
+
+
+async def send_coalesced_text(target: str, text: str, deadline: Optional[float] = None):
+    """Отправить склеенный текст и вернуть message_id созданного сообщения"""
+    if is_discord_webhook(target):
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            None, lambda: send_discord_webhook(target, text=text, wait=True, deadline=deadline)
+        )
+        if response.status_code not in (200, 204):
+            raise RuntimeError(f'Discord webhook failed: {response.status_code} - {response.text}')
+        return response.json().get('id') if response.status_code == 200 else None
+    result = await send_telegram(target, text=text, deadline=deadline)
+    return result.message_id
+
+
+message_coalescer = MessageCoalescer(send_coalesced_text)
+
+# Максимальное окно склеивания, чтобы не держать Flask worker слишком долго
+MAX_COALESCE_MS = 10000
+_coalescing_warned = False
+
+
+def warn_coalescing_unavailable():
+    """Один раз предупредить, что coalesce_ms игнорируется без параллельной обработки запросов"""
+    global _coalescing_warned
+    if not _coalescing_warned:
+        _coalescing_warned = True
+        logger.warning("coalesce_ms ignored: the WSGI server handles one request at a time, "
+                       "run gunicorn with --worker-class gthread --threads N to enable coalescing")
+
+
+def handle_send_request(target: str, text: str = None, image_url: str = None, data: Dict[str, Any] = None):
+    """Общая обработка /send_message и /send_to_channel: отложить или отправить сразу"""
+    file_path = (data or {}).get('file_path')
+    file_type = None
+    try:
+        send_at = parse_send_time(data or {})
+        deadline = parse_deadline(data, request.headers)
+        if file_path:
             if image_url:
-                # Преобразовать image_url в бинарные данные и отправить как multipart/form-data
-                logger.info(f"Discord: Processing image_url for multipart upload")
-                
-                image_data = None
-                image_filename = 'image.jpg'
-                image_mimetype = 'image/jpeg'
-                
-                # Определить тип image_url и получить данные
-                if image_url.startswith('data:image/'):
-                    # Data URL с base64
-                    try:
-                        mime_part = image_url.split(';')[0].replace('data:', '')
-                        image_mimetype = mime_part
-                        if mime_part == 'image/png':
-                            image_filename = 'image.png'
-                        elif mime_part == 'image/gif':
-                            image_filename = 'image.gif'
-                        elif mime_part == 'image/webp':
-                            image_filename = 'image.webp'
-                        
-                        base64_data = image_url.split(',')[1]
-                        image_data = base64.b64decode(base64_data)
-                        logger.info(f"Discord: Decoded data URL, size: {len(image_data)} bytes")
-                    except Exception as e:
-                        logger.error(f"Discord: Error decoding data URL: {e}")
-                        raise
-                
-                elif not image_url.startswith('http'):
-                    # Обычная base64 строка
-                    try:
-                        image_data = base64.b64decode(image_url)
-                        logger.info(f"Discord: Decoded base64 string, size: {len(image_data)} bytes")
-                    except Exception as e:
-                        logger.error(f"Discord: Error decoding base64: {e}")
-                        raise
-                
-                else:
-                    # Это URL - скачать файл
-                    try:
-                        logger.info(f"Discord: Downloading image from URL: {image_url[:100]}")
-                        proxies = proxy_config.get_discord_proxy_dict()
-                        response = requests.get(image_url, timeout=30, proxies=proxies)
-                        response.raise_for_status()
-                        image_data = response.content
-                        logger.info(f"Discord: Downloaded image, size: {len(image_data)} bytes")
-                        
-                        # Определить MIME тип из URL если возможно
-                        if image_url.lower().endswith('.png'):
-                            image_mimetype = 'image/png'
-                            image_filename = 'image.png'
-                        elif image_url.lower().endswith('.gif'):
-                            image_mimetype = 'image/gif'
-                            image_filename = 'image.gif'
-                        elif image_url.lower().endswith('.webp'):
-                            image_mimetype = 'image/webp'
-                            image_filename = 'image.webp'
-                    except Exception as e:
-                        logger.error(f"Discord: Error downloading image from URL: {e}")
-                        raise
-                
-                # Отправить в multipart/form-data
-                files = {'file': (image_filename, BytesIO(image_data), image_mimetype)}
-                data = {'content': text} if text else {}
-                
-                proxies = proxy_config.get_discord_proxy_dict()
-                logger.info(f"Отправка в Discord: {'через прокси' if bool(proxies) else 'без прокси'}")
-                logger.info(f"Discord: Sending image as multipart, filename: {image_filename}, content: {text is not None}")
-                response = requests.post(chat_id, files=files, data=data, proxies=proxies)
-            else:
-                # Только текст
-                payload = {'content': text}
-                proxies = proxy_config.get_discord_proxy_dict()
-                logger.info(f"Отправка в Discord: {'через прокси' if bool(proxies) else 'без прокси'}")
-                logger.info(f"Discord: Sending text only")
-                response = requests.post(
-                    chat_id,
-                    data=json.dumps(payload),
-                    headers={'Content-Type': 'application/json'},
-                    proxies=proxies
+                raise ValueError('image_url and file_path are mutually exclusive')
+            file_path = shared_files.resolve(file_path)
+            file_type = detect_file_type(file_path, (data or {}).get('file_type'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if send_at is not None:
+        job = message_scheduler.schedule(target, send_at, text=text, image_url=image_url,
+                                         file_path=file_path, file_type=file_type, owner=g.api_key.name)
+        logger.info(f"Scheduled message {job['job_id']} to {job['target']} at {send_at}")
+        return jsonify({'status': 'scheduled', **job}), 202
+
+    # Опциональное склеивание текстов одному получателю в окне coalesce_ms
+    coalesce_ms = (data or {}).get('coalesce_ms')
+    if coalesce_ms:
+        if not isinstance(coalesce_ms, int) or isinstance(coalesce_ms, bool) or not 0 < coalesce_ms <= MAX_COALESCE_MS:
+            return jsonify({'error': f'coalesce_ms must be an integer between 1 and {MAX_COALESCE_MS}'}), 400
+        if coalesce_ms / 1000 > remaining(deadline) - MIN_BUDGET:
+            return jsonify({'error': 'coalesce_ms does not fit in the time left before the request deadline'}), 400
+        if not request.environ.get('wsgi.multithread'):
+            # Однопоточный сервер не примет второй запрос, пока этот ждет окно, склеивать нечего
+            warn_coalescing_unavailable()
+        elif text and not image_url and not file_path and user_info_bot.loop and user_info_bot.loop.is_running():
+            limit = DISCORD_TEXT_LIMIT if is_discord_webhook(target) else TELEGRAM_TEXT_LIMIT
+            try:
+                message_id = run_on_bot_loop(
+                    message_coalescer.submit(target, text, coalesce_ms, limit, deadline=deadline),
+                    deadline=deadline
                 )
-            
+                return jsonify({'status': 'success', 'message_id': message_id, 'coalesced': True})
+            except CircuitOpenError as e:
+                return circuit_open_response(e)
+            except (DeadlineExceeded, ClientDisconnected) as e:
+                return deadline_response(e)
+            except Exception as e:
+                logger.error(f"Error sending coalesced message to {target}: {e}", exc_info=True)
+                return jsonify({'error': str(e)}), 500
+
+    # Check if it's a Discord webhook URL
+    if is_discord_webhook(target):
+        try:
+            response = send_discord_webhook(target, text=text, image_url=image_url, deadline=deadline, file_path=file_path)
             if response.status_code in (200, 204):
                 logger.info(f"Discord: Message sent successfully (status {response.status_code})")
                 return jsonify({'status': 'success'})
             else:
                 logger.error(f"Discord: Failed with status {response.status_code}: {response.text}")
                 return jsonify({'error': f'Discord webhook failed: {response.status_code} - {response.text}'}), 500
+        except CircuitOpenError as e:
+            return circuit_open_response(e)
+        except (DeadlineExceeded, requests.Timeout) as e:
+            return deadline_response(e)
         except Exception as e:
             logger.error(f"Discord webhook error: {e}", exc_info=True)
             return jsonify({'error': str(e)}), 500
-    
+
     # Otherwise, treat as Telegram chat ID
     try:
-        logger.info(f"Preparing to send media via Telegram. image_url={image_url}")
-        # Use the event loop from telegram thread via run_coroutine_threadsafe
-        if user_info_bot.loop and user_info_bot.loop.is_running():
-            logger.info("Using existing event loop from telegram thread")
-            future = asyncio.run_coroutine_threadsafe(
-                user_info_bot.send_media(chat_id, text=text, image_url=image_url),
-                user_info_bot.loop
-            )
-            result = future.result(timeout=30)
-        else:
-            logger.warning("Event loop not running, using asyncio.run")
-            result = asyncio.run(user_info_bot.send_media(chat_id, text=text, image_url=image_url))
-        
+        logger.info(f"Preparing to send media via Telegram. has_image_url={bool(image_url)}")
+        result = run_on_bot_loop(
+            send_telegram(target, text=text, image_url=image_url, deadline=deadline, file_path=file_path, file_type=file_type),
+            deadline=deadline
+        )
         logger.info(f"Successfully sent message/photo with message_id: {result.message_id}")
         return jsonify({'status': 'success', 'message_id': result.message_id})
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except (DeadlineExceeded, ClientDisconnected) as e:
+        return deadline_response(e)
     except Exception as e:
-        logger.error(f"Error in send_message_api: {e}", exc_info=True)
+        logger.error(f"Error sending to {target}: {e}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+# Define API endpoints
+@app.route('/send_message', methods=['POST'])
+@capture_traffic('send_message', 'chat_id')
+@require_api_token
+def send_message_api():
+    data = request.get_json()
+    chat_id = data.get('chat_id') if data else None
+    text = data.get('text') if data else None
+    image_url = data.get('image_url') if data else None  # URL, file_id, или base64 строка
+    file_path = data.get('file_path') if data else None  # путь к файлу на общем томе
+    
+    logger.info(f"send_message_api called: chat_id={chat_id}, has_text={bool(text)}, has_image_url={bool(image_url)}, has_file_path={bool(file_path)}")
+    
+    if not chat_id or (not text and not image_url and not file_path):
+        return jsonify({'error': 'chat_id and either text, image_url or file_path are required. image_url может быть URL, file_id или base64'}), 400
+    
+    return handle_send_request(chat_id, text=text, image_url=image_url, data=data)
+
 @app.route('/send_to_channel', methods=['POST'])
+@capture_traffic('send_to_channel', 'channel_id')
 @require_api_token
 def send_to_channel_api():
     data = request.get_json()
     channel_id = data.get('channel_id') if data else None
     text = data.get('text') if data else None
     image_url = data.get('image_url') if data else None  # URL, file_id, или base64 строка
+    file_path = data.get('file_path') if data else None  # путь к файлу на общем томе
     
-    if not channel_id or (not text and not image_url):
-        return jsonify({'error': 'channel_id and either text or image_url are required. image_url может быть URL, file_id или base64'}), 400
-    
-    # Check if it's a Discord webhook URL
-    if channel_id.startswith('https://discord.com/api/webhooks/'):
-        try:
-            if image_url:
-                # Преобразовать image_url в бинарные данные и отправить как multipart/form-data
-                logger.info(f"Discord: Processing image_url for multipart upload")
-                
-                image_data = None
-                image_filename = 'image.jpg'
-                image_mimetype = 'image/jpeg'
-                
-                # Определить тип image_url и получить данные
-                if image_url.startswith('data:image/'):
-                    # Data URL с base64
-                    try:
-                        mime_part = image_url.split(';')[0].replace('data:', '')
-                        image_mimetype = mime_part
-                        if mime_part == 'image/png':
-                            image_filename = 'image.png'
-                        elif mime_part == 'image/gif':
-                            image_filename = 'image.gif'
-                        elif mime_part == 'image/webp':
-                            image_filename = 'image.webp'
-                        
-                        base64_data = image_url.split(',')[1]
-                        image_data = base64.b64decode(base64_data)
-                        logger.info(f"Discord: Decoded data URL, size: {len(image_data)} bytes")
-                    except Exception as e:
-                        logger.error(f"Discord: Error decoding data URL: {e}")
-                        raise
-                
-                elif not image_url.startswith('http'):
-                    # Обычная base64 строка
-                    try:
-                        image_data = base64.b64decode(image_url)
-                        logger.info(f"Discord: Decoded base64 string, size: {len(image_data)} bytes")
-                    except Exception as e:
-                        logger.error(f"Discord: Error decoding base64: {e}")
-                        raise
-                
-                else:
-                    # Это URL - скачать файл
-                    try:
-                        logger.info(f"Discord: Downloading image from URL: {image_url[:100]}")
-                        proxies = proxy_config.get_discord_proxy_dict()
-                        response = requests.get(image_url, timeout=30, proxies=proxies)
-                        response.raise_for_status()
-                        image_data = response.content
-                        logger.info(f"Discord: Downloaded image, size: {len(image_data)} bytes")
-                        
-                        # Определить MIME тип из URL если возможно
-                        if image_url.lower().endswith('.png'):
-                            image_mimetype = 'image/png'
-                            image_filename = 'image.png'
-                        elif image_url.lower().endswith('.gif'):
-                            image_mimetype = 'image/gif'
-                            image_filename = 'image.gif'
-                        elif image_url.lower().endswith('.webp'):
-                            image_mimetype = 'image/webp'
-                            image_filename = 'image.webp'
-                    except Exception as e:
-                        logger.error(f"Discord: Error downloading image from URL: {e}")
-                        raise
-                
-                # Отправить в multipart/form-data
-                files = {'file': (image_filename, BytesIO(image_data), image_mimetype)}
-                data = {'content': text} if text else {}
-                
-                proxies = proxy_config.get_discord_proxy_dict()
-                logger.info(f"Отправка в Discord: {'через прокси' if bool(proxies) else 'без прокси'}")
-                logger.info(f"Discord: Sending image as multipart, filename: {image_filename}, content: {text is not None}")
-                response = requests.post(channel_id, files=files, data=data, proxies=proxies)
-            else:
-                # Только текст
-                payload = {'content': text}
-                proxies = proxy_config.get_discord_proxy_dict()
-                logger.info(f"Отправка в Discord: {'через прокси' if bool(proxies) else 'без прокси'}")
-                logger.info(f"Discord: Sending text only")
-                response = requests.post(
-                    channel_id,
-                    data=json.dumps(payload),
-                    headers={'Content-Type': 'application/json'},
-                    proxies=proxies
-                )
-            
-            if response.status_code in (200, 204):
-                logger.info(f"Discord: Message sent successfully (status {response.status_code})")
-                return jsonify({'status': 'success'})
-            else:
-                logger.error(f"Discord: Failed with status {response.status_code}: {response.text}")
-                return jsonify({'error': f'Discord webhook failed: {response.status_code} - {response.text}'}), 500
-        except Exception as e:
-            logger.error(f"Discord webhook error: {e}", exc_info=True)
-            return jsonify({'error': str(e)}), 500
+    if not channel_id or (not text and not image_url and not file_path):
+        return jsonify({'error': 'channel_id and either text, image_url or file_path are required. image_url может быть URL, file_id или base64'}), 400
     
-    # Otherwise, treat as Telegram channel ID
+    return handle_send_request(channel_id, text=text, image_url=image_url, data=data)
+
+def scheduled_jobs_owner() -> Optional[str]:
+    """Имя ключа, которым ограничен доступ к отложенным заданиям (None для администраторов)"""
+    return None if g.api_key.admin else g.api_key.name
+
+@app.route('/scheduled_messages', methods=['GET'])
+@require_api_token
+def list_scheduled_messages_api():
     try:
-        if user_info_bot.loop and user_info_bot.loop.is_running():
-            logger.info("Using existing event loop from telegram thread")
-            future = asyncio.run_coroutine_threadsafe(
-                user_info_bot.send_media(channel_id, text=text, image_url=image_url),
-                user_info_bot.loop
-            )
-            result = future.result(timeout=30)
-        else:
-            logger.warning("Event loop not running, using asyncio.run")
-            result = asyncio.run(user_info_bot.send_media(channel_id, text=text, image_url=image_url))
-        
-        return jsonify({'status': 'success', 'message_id': result.message_id})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    # Обычные ключи видят только свои задания, администраторские - все
+    owner = scheduled_jobs_owner()
+    return jsonify({
+        'pending': message_scheduler.pending_count(owner=owner),
+        'jobs': message_scheduler.list_jobs(limit=max(1, min(limit, 1000)), owner=owner)
+    })
+
+@app.route('/scheduled_messages/<job_id>', methods=['DELETE'])
+@require_api_token
+def cancel_scheduled_message_api(job_id):
+    if not message_scheduler.cancel(job_id, owner=scheduled_jobs_owner()):
+        return jsonify({'error': 'Scheduled message not found'}), 404
+    return jsonify({'status': 'cancelled', 'job_id': job_id})
+
+@app.route('/api_keys/usage', methods=['GET'])
+@require_admin_token
+def api_keys_usage_api():
+    return jsonify({'keys': api_keys.usage()})
+
+@app.route('/circuit_breakers', methods=['GET'])
+@require_admin_token
+def circuit_breakers_api():
+    return jsonify({'circuits': circuit_breakers.snapshot()})
+
+@app.route('/circuit_breakers', methods=['DELETE'])
+@require_admin_token
+def reset_circuit_breaker_api():
+    data = request.get_json(silent=True) or {}
+    target = data.get('target')
+    if not target:
+        return jsonify({'error': 'target is required'}), 400
+    if not circuit_breakers.reset(target):
+        return jsonify({'error': 'No circuit for this target'}), 404
+    return jsonify({'status': 'reset'})
 
 # Initialize the bot
 bot_token = os.getenv('BOT_TOKEN')
@@ -569,6 +921,8 @@ def run_telegram_bot():
         if not user_info_bot.application:
             # Создать Application с поддержкой SOCKS прокси
             builder = Application.builder().token(user_info_bot.token)
+            if TELEGRAM_API_BASE_URL:
+                builder = builder.base_url(TELEGRAM_API_BASE_URL)
             
             # Если Telegram прокси включен, попытаться использовать его
             if proxy_config.is_telegram_proxy_enabled():
@@ -589,6 +943,10 @@ def run_telegram_bot():
             # Add handlers
             user_info_bot.application.add_handler(CommandHandler("start", user_info_bot.start))
             user_info_bot.application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, user_info_bot.handle_message))
+            user_info_bot.application.add_handler(InlineQueryHandler(user_info_bot.handle_inline_query))
+            
+            # Запоминать update_id каждого обработанного обновления для догона после перезапуска
+            user_info_bot.application.add_handler(TypeHandler(Update, update_backlog.track_update), group=TRACK_GROUP)
             
             # Add error handler
             user_info_bot.application.add_error_handler(user_info_bot.error_handler)
@@ -598,12 +956,22 @@ def run_telegram_bot():
         await application.initialize()
         await application.start()
         if application.updater:
+            # Разобрать накопившуюся очередь по политике догона до начала обычного polling
+            try:
+                await update_backlog.catch_up(application)
+            except Exception as e:
+                logger.error(f"Ошибка при догоне очереди обновлений: {e}", exc_info=True)
             await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
         
+        # Запустить таймер отложенных сообщений на этом event loop
+        message_scheduler.attach(asyncio.get_running_loop(), send_scheduled_message, is_retryable_send_error)
+        
         # Keep the bot running
         try:
             while True:
                 await asyncio.sleep(1)
+                # Дописать offset, если после последнего обновления прошел интервал сохранения
+                update_backlog.save()
         except asyncio.CancelledError:
             pass
         finally:
@@ -611,6 +979,7 @@ def run_telegram_bot():
                 await application.updater.stop()
             await application.stop()
             await application.shutdown()
+            update_backlog.save(force=True)
     
     try:
         loop.run_until_complete(start_bot())
@@ -622,3 +991,6 @@ def run_telegram_bot():
 telegram_thread = threading.Thread(target=run_telegram_bot)
 telegram_thread.daemon = True
 telegram_thread.start()
+
+# Поток бота - daemon и при остановке gunicorn не доходит до finally, поэтому offset сохраняется здесь
+atexit.register(update_backlog.save, force=True)
@@ -1,14 +1,19 @@
 import asyncio
 import logging
-from telegram import Update
+from telegram import Update, Bot
+from telegram.error import RetryAfter
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
 from telegram.ext import Application
+from telegram.request import HTTPXRequest
 import os
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Iterable
 import json
 from flask import Flask, request, jsonify
 import threading
 import secrets
+import argparse
+import sys
+import time
 
 # Enable logging
 logging.basicConfig(
@@ -17,6 +22,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Bulk send tuning
+BULK_MAX_RETRIES = 3
+BULK_PROGRESS_EVERY = 100
+BULK_POOL_TIMEOUT = 30.0
+
 class UserInfoBot:
     def __init__(self, token: str):
         self.token = token
@@ -144,12 +154,124 @@ class UserInfoBot:
 
     async def send_message(self, chat_id: str, text: str, **kwargs):
         """Send a message to a chat ID."""
-        # Create a temporary application just for sending the message
-        temp_app = Application.builder().token(self.token).build()
-        bot = temp_app.bot
-        result = await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        # Reuse one initialized Bot instead of building an Application per message
+        if self.bot is None:
+            self.bot = Bot(self.token)
+        await self.bot.initialize()  # no-op once initialized
+        result = await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
         return result
-    
+
+    async def _send_record(self, record: Dict[str, Any]):
+        """Send one bulk record, waiting out Telegram flood control."""
+        for attempt in range(BULK_MAX_RETRIES + 1):
+            try:
+                if record.get('image'):
+                    return await self.bot.send_photo(chat_id=record['chat_id'], photo=record['image'], caption=record.get('text'))
+                return await self.bot.send_message(chat_id=record['chat_id'], text=record['text'])
+            except RetryAfter as e:
+                if attempt == BULK_MAX_RETRIES:
+                    raise
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                logger.warning(f"Flood control for {record['chat_id']}, retrying in {retry_after}s")
+                await asyncio.sleep(retry_after)
+
+    async def bulk_send(self, lines: Iterable[str], concurrency: int = 8, rate: float = 25.0,
+                        start_offset: int = 0, progress_path: Optional[str] = None,
+                        failures_path: Optional[str] = None) -> Dict[str, Any]:
+        """Stream JSONL records ({"chat_id", "text", "image"}) and send them with one Bot.
+
+        At most `concurrency` sends are in flight and sends start no faster than `rate` per second.
+        The progress file records `offset`: every line before it has been sent or logged as failed,
+        so an interrupted run can be resumed from there. Failed records are appended to the failures
+        file as complete records, so that file can be fed to another run.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        interval = 1.0 / rate if rate > 0 else 0.0
+        next_start = 0.0
+        stats = {'offset': start_offset, 'sent': 0, 'failed': 0, 'skipped': start_offset}
+        done_ahead = set()  # finished line numbers past the resume offset
+        tasks = set()
+        failures = open(failures_path, 'a', encoding='utf-8') if failures_path else None
+        started = time.monotonic()
+
+        def write_progress():
+            if not progress_path:
+                return
+            tmp_path = progress_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({**stats, 'elapsed': round(time.monotonic() - started, 3)}, f)
+            os.replace(tmp_path, progress_path)
+
+        def record_failure(line_no: int, record: Optional[Dict[str, Any]], error: str, raw: Optional[str] = None):
+            stats['failed'] += 1
+            logger.error(f"Line {line_no + 1}: {error}")
+            if failures:
+                entry = {**record} if record is not None else {'raw': raw}
+                entry.update({'line': line_no + 1, 'error': error})
+                failures.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                failures.flush()
+
+        def finish(line_no: int):
+            done_ahead.add(line_no)
+            while stats['offset'] in done_ahead:
+                done_ahead.remove(stats['offset'])
+                stats['offset'] += 1
+            done = stats['sent'] + stats['failed']
+            if done % BULK_PROGRESS_EVERY == 0:
+                write_progress()
+                logger.info(f"Progress: sent={stats['sent']} failed={stats['failed']} offset={stats['offset']}")
+
+        async def worker(line_no: int, record: Dict[str, Any]):
+            # A cancelled send (e.g. Ctrl-C) is neither sent nor failed, so the offset must not pass it
+            try:
+                await self._send_record(record)
+                stats['sent'] += 1
+            except Exception as e:
+                record_failure(line_no, record, str(e))
+            finally:
+                semaphore.release()
+            finish(line_no)
+
+        # The default request keeps a single connection, which would serialize all sends
+        self.bot = Bot(self.token, request=HTTPXRequest(connection_pool_size=concurrency,
+                                                         pool_timeout=BULK_POOL_TIMEOUT))
+        try:
+            async with self.bot:
+                for line_no, line in enumerate(lines):
+                    if line_no < start_offset:
+                        continue
+                    line = line.strip()
+                    record = None
+                    try:
+                        record = json.loads(line) if line else None
+                        if not isinstance(record, dict) or not record.get('chat_id') or not (record.get('text') or record.get('image')):
+                            raise ValueError('record needs chat_id and either text or image')
+                    except ValueError as e:
+                        # JSON objects are logged as records so the failures file stays valid input
+                        record_failure(line_no, record if isinstance(record, dict) else None,
+                                       f"Invalid record: {e}", raw=line)
+                        finish(line_no)
+                        continue
+
+                    await semaphore.acquire()
+                    if interval:
+                        now = time.monotonic()
+                        if next_start > now:
+                            await asyncio.sleep(next_start - now)
+                        next_start = max(now, next_start) + interval
+                    task = asyncio.create_task(worker(line_no, record))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                if tasks:
+                    await asyncio.gather(*tasks)
+        finally:
+            write_progress()
+            if failures:
+                failures.close()
+
+        logger.info(f"Bulk send finished: sent={stats['sent']} failed={stats['failed']} offset={stats['offset']}")
+        return stats
 
     def run(self, token: Optional[str] = None):
         """Run the bot with the provided token."""
@@ -171,28 +293,60 @@ class UserInfoBot:
         self.application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
-if __name__ == '__main__':
+def main():
+    parser = argparse.ArgumentParser(description='UserInfoBot')
+    subparsers = parser.add_subparsers(dest='command')
+    send_parser = subparsers.add_parser('send', help='Bulk-send messages from a JSONL file')
+    send_parser.add_argument('--input', default='-', help="JSONL file with chat_id/text/image records, '-' for stdin")
+    send_parser.add_argument('--concurrency', type=int, default=8, help='Maximum sends in flight')
+    send_parser.add_argument('--rate', type=float, default=25.0, help='Maximum sends started per second (0 disables)')
+    send_parser.add_argument('--progress', help='File to write progress and the resume offset to')
+    send_parser.add_argument('--failures', help='JSONL file to append failed records to')
+    send_parser.add_argument('--resume', action='store_true', help='Continue from the offset in the progress file')
+    send_parser.add_argument('--offset', type=int, default=0, help='Number of input lines to skip')
+    args = parser.parse_args()
+    if args.command == 'send':
+        if args.concurrency < 1:
+            parser.error('--concurrency must be at least 1')
+        if args.offset < 0:
+            parser.error('--offset must not be negative')
+
     bot_token = os.getenv('BOT_TOKEN')
     if not bot_token:
         raise ValueError("Please set the BOT_TOKEN environment variable")
     
     user_info_bot = UserInfoBot(bot_token)
-    
+
+    if args.command != 'send':
+        user_info_bot.run(bot_token)
+        return
+
+    offset = args.offset
+    if args.resume:
+        if not args.progress:
+            parser.error('--resume requires --progress')
+        if os.path.exists(args.progress):
+            with open(args.progress, encoding='utf-8') as f:
+                offset = json.load(f)['offset']
+            if not isinstance(offset, int) or offset < 0:
+                parser.error(f"invalid offset {offset!r} in {args.progress}")
+            logger.info(f"Resuming from line offset {offset}")
+
+    source = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    try:
+        stats = asyncio.run(user_info_bot.bulk_send(
+            source,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            start_offset=offset,
+            progress_path=args.progress,
+            failures_path=args.failures,
+        ))
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    sys.exit(1 if stats['failed'] else 0)
+
+
 if __name__ == '__main__':
-    bot_token = os.getenv('BOT_TOKEN')
-    if not bot_token:
-        raise ValueError("Please set the BOT_TOKEN environment variable")
-    
-    user_info_bot = UserInfoBot(bot_token)
-    user_info_bot.run(bot_token)
-    
-    # Start the Flask app in a separate thread
-    def run_flask():
-        app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
-    
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
-    
-    # Run the Telegram bot
-    user_info_bot.run(bot_token)
\ No newline at end of file
+    main()
@@ -0,0 +1,161 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Получатель временно отключен, запрос отклонен без обращения к API"""
+
+    def __init__(self, target: str, retry_after: float, reason: str):
+        self.target = target
+        self.retry_after = retry_after
+        self.reason = reason
+        super().__init__(f"Destination unavailable ({reason}), retry after {int(retry_after + 0.999)}s")
+
+
+class _Circuit:
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.cooldown = 0.0
+        self.reason = ''
+        self.probe_in_flight = False
+        self.updated = 0.0
+
+
+class CircuitBreakerRegistry:
+    """Circuit breaker на каждого получателя (chat_id или URL Discord webhook).
+
+    Постоянная ошибка (403, 404, chat not found) сразу размыкает цепь на
+    permanent_cooldown секунд, временные ошибки - после failure_threshold
+    подряд. По истечении паузы пропускается одна пробная отправка
+    (half-open): успех замыкает цепь, ошибка снова размыкает ее с удвоенной паузой.
+    Хранятся только получатели с ошибками, поэтому память не растет от успешных отправок.
+    Записи без ошибок дольше самой длинной паузы удаляются, а число записей
+    ограничено max_entries (вытесняются самые давно обновленные).
+    """
+
+    def __init__(self, failure_threshold: int = 5, transient_cooldown: float = 30.0,
+                 permanent_cooldown: float = 600.0, max_cooldown: float = 3600.0, max_entries: int = 10000):
+        self.failure_threshold = failure_threshold
+        self.transient_cooldown = transient_cooldown
+        self.permanent_cooldown = permanent_cooldown
+        self.max_cooldown = max_cooldown
+        self.max_entries = max(1, max_entries)
+        # Пауза разомкнутой цепи никогда не длиннее idle_ttl, поэтому такие записи можно забыть
+        self.idle_ttl = max(max_cooldown, permanent_cooldown, transient_cooldown)
+        # Порядок - по времени последнего обновления записи, самые старые в начале
+        self._circuits: "OrderedDict[str, _Circuit]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _touch(self, target: str, circuit: _Circuit, now: float):
+        circuit.updated = now
+        self._circuits.move_to_end(target)
+
+    def _evict(self, now: float):
+        """Удалить устаревшие записи и лишние сверх max_entries. Вызывается под блокировкой"""
+        while self._circuits:
+            target, circuit = next(iter(self._circuits.items()))
+            if now - circuit.updated <= self.idle_ttl and len(self._circuits) <= self.max_entries:
+                break
+            del self._circuits[target]
+
+    def check(self, target: str):
+        """Разрешить отправку или выбросить CircuitOpenError"""
+        with self._lock:
+            now = time.monotonic()
+            self._evict(now)
+            circuit = self._circuits.get(target)
+            if circuit is None or circuit.state == CLOSED:
+                return
+            remaining = circuit.opened_at + circuit.cooldown - now
+            if circuit.state == OPEN and remaining <= 0:
+                circuit.state = HALF_OPEN
+            if circuit.state == HALF_OPEN and not circuit.probe_in_flight:
+                circuit.probe_in_flight = True
+                self._touch(target, circuit, now)
+                logger.info(f"Circuit half-open, probing {mask_target(target)}")
+                return
+            raise CircuitOpenError(target, max(remaining, 1.0), circuit.reason)
+
+    def record_success(self, target: str):
+        with self._lock:
+            circuit = self._circuits.pop(target, None)
+        if circuit is not None and circuit.state != CLOSED:
+            logger.info(f"Circuit closed for {mask_target(target)}")
+
+    def record_failure(self, target: str, permanent: bool, reason: str):
+        with self._lock:
+            now = time.monotonic()
+            circuit = self._circuits.setdefault(target, _Circuit())
+            self._touch(target, circuit, now)
+            self._evict(now)
+            circuit.failures += 1
+            circuit.reason = reason
+            if circuit.state == OPEN:
+                # Запрос начался до размыкания цепи, пауза уже идет
+                return
+            if circuit.state == HALF_OPEN:
+                cooldown = min(self.max_cooldown, max(circuit.cooldown * 2, self.transient_cooldown))
+            elif permanent:
+                cooldown = self.permanent_cooldown
+            elif circuit.failures >= self.failure_threshold:
+                cooldown = self.transient_cooldown
+            else:
+                return
+            circuit.state = OPEN
+            circuit.opened_at = now
+            circuit.cooldown = cooldown
+            circuit.probe_in_flight = False
+        logger.warning(f"Circuit open for {mask_target(target)} for {cooldown:.0f}s: {reason}")
+
+    def release_probe(self, target: str):
+        """Вернуть право на пробную отправку, если она завершилась без вердикта"""
+        with self._lock:
+            circuit = self._circuits.get(target)
+            if circuit is not None:
+                circuit.probe_in_flight = False
+
+    def reset(self, target: str) -> bool:
+        with self._lock:
+            return self._circuits.pop(target, None) is not None
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            return [{
+                'target': mask_target(target),
+                'state': circuit.state,
+                'failures': circuit.failures,
+                'reason': circuit.reason,
+                'retry_after': max(0.0, round(circuit.opened_at + circuit.cooldown - now, 1)) if circuit.state != CLOSED else 0.0,
+            } for target, circuit in self._circuits.items()]
+
+
+def mask_target(target: str) -> str:
+    """Скрыть секретную часть URL Discord webhook"""
+    if target.startswith('https://discord.com/api/webhooks/'):
+        parts = target.rstrip('/').split('/')
+        if len(parts) >= 7:
+            return '/'.join(parts[:6]) + '/***'
+    return target
+
+
+# Глобальный реестр circuit breaker'ов
+circuit_breakers = CircuitBreakerRegistry(
+    failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5')),
+    transient_cooldown=float(os.getenv('CIRCUIT_TRANSIENT_COOLDOWN', '30')),
+    permanent_cooldown=float(os.getenv('CIRCUIT_PERMANENT_COOLDOWN', '600')),
+    max_entries=int(os.getenv('CIRCUIT_MAX_ENTRIES', '10000')),
+)
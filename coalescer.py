@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List, Callable, Awaitable
+
+from circuit_breaker import mask_target
+from deadline import MIN_BUDGET, remaining
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина одного сообщения
+TELEGRAM_TEXT_LIMIT = 4096
+DISCORD_TEXT_LIMIT = 2000
+
+
+def split_text(text: str, limit: int) -> List[str]:
+    """Разбить текст на части не длиннее limit, по возможности по переводам строк"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+
+def pack_texts(texts: List[str], limit: int):
+    """Склеить тексты через перевод строки в сообщения не длиннее limit.
+
+    Возвращает (chunks, owners), где owners[i] - индекс сообщения,
+    в котором начинается texts[i].
+    """
+    chunks: List[str] = []
+    owners: List[int] = []
+    current = None
+    for text in texts:
+        pieces = split_text(text, limit)
+        first = pieces[0]
+        if current is not None and len(current) + 1 + len(first) <= limit:
+            current += '\n' + first
+        else:
+            if current is not None:
+                chunks.append(current)
+            current = first
+        owners.append(len(chunks))
+        for piece in pieces[1:]:
+            chunks.append(current)
+            current = piece
+    if current is not None:
+        chunks.append(current)
+    return chunks, owners
+
+
+class _Batch:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.texts: List[str] = []
+        self.futures: List[asyncio.Future] = []
+        self.deadlines: List[Optional[float]] = []
+        self.size = 0
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.flush_at = 0.0
+
+    def deadline(self) -> Optional[float]:
+        """Самый ранний дедлайн среди вызывающих - до него должна завершиться отправка"""
+        deadlines = [d for d in self.deadlines if d is not None]
+        return min(deadlines) if deadlines else None
+
+
+class MessageCoalescer:
+    """Склеивание текстов, адресованных одному получателю в пределах окна.
+
+    Работает только на event loop бота. Первый текст открывает окно
+    window_ms для своего получателя; все тексты, пришедшие за это время,
+    отправляются одним сообщением (или несколькими, если превышен лимит длины).
+    Каждый вызывающий получает message_id сообщения, в котором оказался его текст.
+
+    Окно закрывается раньше, если иначе не успеть до дедлайна кого-то из
+    вызывающих, а отправка ограничена самым ранним дедлайном. Текст вызывающего,
+    отмененного до отправки пачки, из нее удаляется.
+    """
+
+    def __init__(self, sender: Callable[[str, str, Optional[float]], Awaitable[Any]]):
+        self._sender = sender
+        self._batches: Dict[str, _Batch] = {}
+        self.stats = {'submitted': 0, 'sent': 0}
+
+    async def submit(self, target: str, text: str, window_ms: int, limit: int,
+                     deadline: Optional[float] = None) -> Any:
+        loop = asyncio.get_running_loop()
+        flush_at = loop.time() + window_ms / 1000
+        if deadline is not None:
+            flush_at = min(flush_at, loop.time() + remaining(deadline) - MIN_BUDGET)
+        batch = self._batches.get(target)
+        if batch is None:
+            batch = _Batch(limit)
+            self._batches[target] = batch
+        if batch.handle is None or flush_at < batch.flush_at:
+            if batch.handle:
+                batch.handle.cancel()
+            batch.flush_at = flush_at
+            batch.handle = loop.call_at(flush_at, self._flush, target)
+
+        future = loop.create_future()
+        batch.texts.append(text)
+        batch.futures.append(future)
+        batch.deadlines.append(deadline)
+        batch.size += len(text) + 1
+        self.stats['submitted'] += 1
+
+        # Полное сообщение нет смысла задерживать до конца окна
+        if batch.size >= batch.limit:
+            self._flush(target)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self._withdraw(target, batch, future)
+            raise
+
+    def _withdraw(self, target: str, batch: _Batch, future: asyncio.Future):
+        """Убрать текст отмененного вызывающего, если пачка еще не отправляется"""
+        if self._batches.get(target) is not batch:
+            return
+        index = batch.futures.index(future)
+        text = batch.texts.pop(index)
+        batch.futures.pop(index)
+        batch.deadlines.pop(index)
+        batch.size -= len(text) + 1
+        if not batch.futures:
+            batch.handle.cancel()
+            del self._batches[target]
+
+    def _flush(self, target: str):
+        batch = self._batches.pop(target, None)
+        if batch is None:
+            return
+        if batch.handle:
+            batch.handle.cancel()
+        asyncio.get_running_loop().create_task(self._send(target, batch))
+
+    async def _send(self, target: str, batch: _Batch):
+        chunks, owners = pack_texts(batch.texts, batch.limit)
+        logger.info(f"Coalescer: {len(batch.texts)} texts to {mask_target(target)} merged into {len(chunks)} message(s)")
+        deadline = batch.deadline()
+        results = []
+        try:
+            for chunk in chunks:
+                results.append(await self._sender(target, chunk, deadline))
+                self.stats['sent'] += 1
+        except Exception as e:
+            # Тексты, попавшие в уже отправленные сообщения, считаются доставленными
+            for future, owner in zip(batch.futures, owners):
+                if not future.done():
+                    if owner < len(results):
+                        future.set_result(results[owner])
+                    else:
+                        future.set_exception(e)
+            return
+        for future, owner in zip(batch.futures, owners):
+            if not future.done():
+                future.set_result(results[owner])
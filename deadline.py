@@ -0,0 +1,88 @@
+import os
+import time
+import socket
+import logging
+from typing import Optional, Dict, Any, Mapping
+
+logger = logging.getLogger(__name__)
+
+# Бюджет по умолчанию, если клиент не передал дедлайн
+DEFAULT_TIMEOUT = float(os.getenv('DEFAULT_REQUEST_TIMEOUT', '30'))
+# Меньше этого времени нет смысла начинать загрузку или отправку
+MIN_BUDGET = float(os.getenv('MIN_REQUEST_BUDGET', '0.5'))
+
+
+class DeadlineExceeded(Exception):
+    """Дедлайн запроса истек или оставшегося времени не хватит на операцию"""
+
+
+class ClientDisconnected(Exception):
+    """Клиент закрыл соединение, не дождавшись ответа"""
+
+
+def parse_deadline(data: Optional[Dict[str, Any]], headers: Mapping[str, str]) -> float:
+    """Получить дедлайн запроса (unix time).
+
+    Абсолютный дедлайн - поле deadline или заголовок X-Request-Deadline (unix timestamp),
+    относительный - поле timeout или заголовок X-Request-Timeout (секунды).
+    Берется самый ранний из заданных, но не позже DEFAULT_TIMEOUT от текущего момента.
+    """
+    data = data or {}
+    now = time.time()
+    deadline = now + DEFAULT_TIMEOUT
+
+    for value in (data.get('deadline'), headers.get('X-Request-Deadline')):
+        if value is not None:
+            try:
+                deadline = min(deadline, float(value))
+            except (TypeError, ValueError):
+                raise ValueError('deadline must be a unix timestamp')
+
+    for value in (data.get('timeout'), headers.get('X-Request-Timeout')):
+        if value is not None:
+            try:
+                timeout = float(value)
+            except (TypeError, ValueError):
+                raise ValueError('timeout must be a number of seconds')
+            if timeout <= 0:
+                raise ValueError('timeout must be positive')
+            deadline = min(deadline, now + timeout)
+
+    return deadline
+
+
+def remaining(deadline: Optional[float]) -> Optional[float]:
+    """Оставшееся время до дедлайна в секундах (None - без ограничения)"""
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def ensure_budget(deadline: Optional[float], what: str) -> Optional[float]:
+    """Проверить, что на операцию what осталось хотя бы MIN_BUDGET секунд.
+
+    Возвращает оставшееся время, чтобы использовать его как таймаут операции.
+    """
+    left = remaining(deadline)
+    if left is not None and left < MIN_BUDGET:
+        raise DeadlineExceeded(f"Deadline exceeded before {what}")
+    return left
+
+
+def cap_timeout(timeout: float, deadline: Optional[float]) -> float:
+    """Ограничить таймаут операции оставшимся временем до дедлайна"""
+    left = remaining(deadline)
+    return timeout if left is None else max(0.1, min(timeout, left))
+
+
+def client_disconnected(environ: Mapping[str, Any]) -> bool:
+    """Проверить, закрыл ли клиент соединение (gunicorn и werkzeug отдают сокет в environ)"""
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError:
+        return True
@@ -0,0 +1,72 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Optional, Any, Hashable
+
+
+class TTLCache:
+    """LRU кэш ограниченного размера с временем жизни записей"""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class EntityDirectory:
+    """Пользователи и каналы с username, которых бот уже видел, для поиска по @username"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entities: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def remember(self, entity: Any):
+        """Запомнить telegram User или Chat, если у него есть username"""
+        username = getattr(entity, 'username', None)
+        if not username:
+            return
+        with self._lock:
+            self._entities[username.lower()] = entity
+            self._entities.move_to_end(username.lower())
+            while len(self._entities) > self.max_size:
+                self._entities.popitem(last=False)
+
+    def find(self, username: str) -> Optional[Any]:
+        with self._lock:
+            return self._entities.get(username.lstrip('@').lower())
+
+
+# Отрисованные ответы на inline запросы по (user_id, язык, запрос)
+INLINE_CACHE_TTL = float(os.getenv('INLINE_CACHE_TTL', '300'))
+# Сколько секунд Telegram может отдавать ответ из своего кэша
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '300'))
+
+inline_results_cache = TTLCache(ttl=INLINE_CACHE_TTL, max_size=int(os.getenv('INLINE_CACHE_SIZE', '10000')))
+known_entities = EntityDirectory(max_size=int(os.getenv('KNOWN_ENTITIES_MAX', '100000')))
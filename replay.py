@@ -0,0 +1,318 @@
+"""Replay captured API traffic (see traffic_capture.py) for load testing.
+
+Start local Telegram/Discord stand-ins and point the app at them:
+
+    python replay.py stand-ins --port 8081 --latency-ms 80
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot DISCORD_API_BASE_URL=http://127.0.0.1:8081 gunicorn --worker-class gthread --threads 16 app:app
+
+Then replay a capture at 1x, 10x or maximum speed and get latency distributions:
+
+    python replay.py run --capture logs/traffic.jsonl --url http://127.0.0.1:5000 --token API_TOKEN --speed 10
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import base64
+import random
+import argparse
+import threading
+import concurrent.futures
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional
+
+import requests
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Percentile by nearest rank"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Minimal Telegram Bot API and Discord webhook responses with configurable latency"""
+
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    jitter = 0.0
+    counter = 0
+    counter_lock = threading.Lock()
+
+    def _read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip() or b'0', 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _reply(self, status: int, payload: Optional[Dict[str, Any]] = None, body: bytes = b'',
+               content_type: str = 'application/json'):
+        if payload is not None:
+            body = json.dumps(payload).encode()
+        self.send_response(status)
+        if body:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _next_id(self) -> int:
+        with self.counter_lock:
+            StandInHandler.counter += 1
+            return StandInHandler.counter
+
+    def _delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def do_GET(self):
+        match = re.match(r'^/image/(\d+)\.jpg$', self.path)
+        if not match:
+            return self._reply(404, {'error': 'not found'})
+        self._reply(200, body=os.urandom(int(match.group(1))), content_type='image/jpeg')
+
+    def do_POST(self):
+        self._read_body()
+        telegram = re.match(r'^/bot[^/]+/(\w+)', self.path)
+        if telegram:
+            method = telegram.group(1)
+            if method == 'getMe':
+                result = {'id': 1, 'is_bot': True, 'first_name': 'stand-in', 'username': 'stand_in_bot'}
+            elif method == 'getUpdates':
+                time.sleep(1)
+                result = []
+            elif method.startswith('send'):
+                self._delay()
+                result = {'message_id': self._next_id(), 'date': int(time.time()),
+                          'chat': {'id': 1, 'type': 'private'}}
+            else:
+                result = True
+            return self._reply(200, {'ok': True, 'result': result})
+
+        if self.path.startswith('/api/webhooks/'):
+            self._delay()
+            if 'wait=true' in self.path:
+                return self._reply(200, {'id': str(self._next_id())})
+            return self._reply(204)
+
+        self._reply(404, {'error': 'not found'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_stand_ins(args):
+    StandInHandler.latency = args.latency_ms / 1000
+    StandInHandler.jitter = args.jitter_ms / 1000
+    server = ThreadingHTTPServer((args.host, args.port), StandInHandler)
+    print(f"Stand-ins listening on http://{args.host}:{args.port}")
+    print(f"  TELEGRAM_API_BASE_URL=http://{args.host}:{args.port}/bot")
+    print(f"  DISCORD_API_BASE_URL=http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+class PayloadBuilder:
+    """Rebuild request bodies with the recorded shape from capture records"""
+
+    def __init__(self, image_base_url: str):
+        self.image_base_url = image_base_url.rstrip('/')
+        self._blobs: Dict[int, str] = {}
+
+    def _base64(self, size: int) -> str:
+        if size not in self._blobs:
+            self._blobs[size] = base64.b64encode(os.urandom(max(size, 1))).decode()
+        return self._blobs[size]
+
+    def build(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        tgt = record.get('tgt') or '0'
+        if record.get('dst') == 'dc':
+            target = f"https://discord.com/api/webhooks/{int(tgt[:8], 16)}/{tgt}"
+        else:
+            target = str(int(tgt[:8], 16))
+        body = {'chat_id' if record['ep'] == 'send_message' else 'channel_id': target}
+
+        if record.get('txt'):
+            body['text'] = 'x' * record['txt']
+        kind = record.get('img')
+        size = record.get('img_b') or 50000
+        if kind == 'url':
+            body['image_url'] = f"{self.image_base_url}/image/{size}.jpg"
+        elif kind in ('base64', 'file'):
+            # Captured file paths are not replayable; the same number of bytes is sent inline instead
+            body['image_url'] = self._base64(size)
+        elif kind == 'data_url':
+            body['image_url'] = 'data:image/jpeg;base64,' + self._base64(size)
+
+        # Scheduling options are dropped: replayed jobs would be stored in the app's scheduler
+        # database and fire later, so scheduled requests are replayed as immediate sends
+        opts = dict(record.get('opts') or {})
+        opts.pop('send_at', None)
+        opts.pop('delay', None)
+        # The deadline is kept relative to the request start, so it is rebuilt at send time
+        deadline_in = opts.pop('deadline_in', None)
+        if deadline_in is not None:
+            body['deadline'] = time.time() + deadline_in
+        body.update(opts)
+        return body
+
+
+def load_capture(path: str) -> List[Dict[str, Any]]:
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            # Requests rejected at authentication carry no shape to replay
+            if record.get('st') == 401 or not record.get('tgt'):
+                continue
+            records.append(record)
+    records.sort(key=lambda r: r['ts'])
+    return records
+
+
+def run_replay(args):
+    records = load_capture(args.capture)
+    if not records:
+        print('No replayable records in capture')
+        return 1
+    speed = None if args.speed == 'max' else float(args.speed)
+    builder = PayloadBuilder(args.image_base_url)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    headers = {'Authorization': f'Bearer {args.token}'}
+    results = []
+    results_lock = threading.Lock()
+
+    def send(record: Dict[str, Any], body: Dict[str, Any], due: float):
+        started = time.monotonic()
+        try:
+            response = session.post(f"{args.url.rstrip('/')}/{record['ep']}", json=body, headers=headers, timeout=120)
+            status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = (time.monotonic() - started) * 1000
+        with results_lock:
+            results.append({'record': record, 'status': status, 'ms': elapsed, 'lag_ms': (started - due) * 1000})
+
+    first_ts = records[0]['ts']
+    print(f"Replaying {len(records)} requests at {'max' if speed is None else f'{speed:g}x'} speed")
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for record in records:
+            due = started + ((record['ts'] - first_ts) / speed if speed else 0)
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            body = builder.build(record)
+            pool.submit(send, record, body, due)
+    duration = time.monotonic() - started
+
+    report = build_report(results, duration)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+def build_report(results: List[Dict[str, Any]], duration: float) -> Dict[str, Any]:
+    groups = defaultdict(list)
+    for result in results:
+        record = result['record']
+        groups[f"{record['ep']} {record['dst']} {record.get('img') or 'text'}"].append(result)
+
+    def summary(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        latencies = [item['ms'] for item in items]
+        recorded = [item['record']['ms'] for item in items if 'ms' in item['record']]
+        statuses = defaultdict(int)
+        for item in items:
+            statuses[str(item['status'])] += 1
+        return {
+            'count': len(items),
+            'status': dict(statuses),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p90_ms': round(percentile(latencies, 90), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'max_ms': round(max(latencies), 1) if latencies else 0.0,
+            'recorded_p50_ms': round(percentile(recorded, 50), 1),
+            'recorded_p99_ms': round(percentile(recorded, 99), 1),
+        }
+
+    return {
+        'requests': len(results),
+        'duration_s': round(duration, 2),
+        'throughput_rps': round(len(results) / duration, 1) if duration else 0.0,
+        'start_lag_p99_ms': round(percentile([r['lag_ms'] for r in results], 99), 1),
+        'overall': summary(results),
+        'groups': {name: summary(items) for name, items in sorted(groups.items())},
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"\n{report['requests']} requests in {report['duration_s']}s "
+          f"({report['throughput_rps']} req/s, start lag p99 {report['start_lag_p99_ms']} ms)\n")
+    print(f"{'group':<32}{'count':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'rec p50':>9}{'rec p99':>9}  status")
+    rows = list(report['groups'].items()) + [('overall', report['overall'])]
+    for name, s in rows:
+        status = ' '.join(f"{code}:{n}" for code, n in sorted(s['status'].items()))
+        print(f"{name:<32}{s['count']:>7}{s['p50_ms']:>9}{s['p90_ms']:>9}{s['p99_ms']:>9}{s['max_ms']:>9}"
+              f"{s['recorded_p50_ms']:>9}{s['recorded_p99_ms']:>9}  {status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured /send_message and /send_to_channel traffic')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    stand_ins = subparsers.add_parser('stand-ins', help='Run local Telegram and Discord stand-ins')
+    stand_ins.add_argument('--host', default='127.0.0.1')
+    stand_ins.add_argument('--port', type=int, default=8081)
+    stand_ins.add_argument('--latency-ms', type=float, default=50.0, help='Base latency of send calls')
+    stand_ins.add_argument('--jitter-ms', type=float, default=20.0, help='Random extra latency of send calls')
+
+    run = subparsers.add_parser('run', help='Replay a capture against the app')
+    run.add_argument('--capture', required=True, help='JSONL file written with TRAFFIC_CAPTURE_PATH')
+    run.add_argument('--url', default='http://127.0.0.1:5000', help='Base URL of the app')
+    run.add_argument('--token', default=os.getenv('API_TOKEN'), help='API token (default: $API_TOKEN)')
+    run.add_argument('--speed', default='1', help="Replay speed multiplier, e.g. 1 or 10, or 'max'")
+    run.add_argument('--concurrency', type=int, default=32, help='Maximum requests in flight')
+    run.add_argument('--image-base-url', default='http://127.0.0.1:8081',
+                     help='Stand-in base URL that serves images for URL-image requests')
+    run.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    args = parser.parse_args()
+    if args.command == 'stand-ins':
+        run_stand_ins(args)
+        return 0
+    if not args.token:
+        parser.error('--token or API_TOKEN is required')
+    if args.speed != 'max':
+        try:
+            if float(args.speed) <= 0:
+                raise ValueError
+        except ValueError:
+            parser.error("--speed must be a positive number or 'max'")
+    return run_replay(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
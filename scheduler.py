@@ -0,0 +1,341 @@
+import os
+import json
+import math
+import time
+import heapq
+import sqlite3
+import asyncio
+import logging
+import secrets
+import threading
+import concurrent.futures
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, List, Callable, Awaitable
+
+from circuit_breaker import mask_target
+
+logger = logging.getLogger(__name__)
+
+# Сколько наступивших заданий отправлять одновременно
+SCHEDULER_CONCURRENCY = int(os.getenv('SCHEDULER_CONCURRENCY', '8'))
+# Повторы заданий после временных ошибок: число попыток и начальная пауза (удваивается)
+SCHEDULER_MAX_ATTEMPTS = int(os.getenv('SCHEDULER_MAX_ATTEMPTS', '5'))
+SCHEDULER_RETRY_DELAY = float(os.getenv('SCHEDULER_RETRY_DELAY', '30'))
+
+
+def parse_send_time(data: Dict[str, Any]) -> Optional[float]:
+    """Получить момент отправки (unix time) из полей send_at / delay запроса.
+
+    send_at - unix timestamp или строка ISO 8601, delay - задержка в секундах.
+    Возвращает None если ни одно поле не задано, ValueError при неверном формате.
+    """
+    send_at = data.get('send_at')
+    delay = data.get('delay')
+
+    if send_at is not None and delay is not None:
+        raise ValueError('send_at and delay are mutually exclusive')
+
+    if delay is not None:
+        try:
+            delay = float(delay)
+        except (TypeError, ValueError):
+            raise ValueError('delay must be a number of seconds')
+        if not math.isfinite(delay):
+            raise ValueError('delay must be a finite number of seconds')
+        if delay < 0:
+            raise ValueError('delay must not be negative')
+        return time.time() + delay
+
+    if send_at is not None:
+        if isinstance(send_at, (int, float)) and not isinstance(send_at, bool):
+            if not math.isfinite(send_at):
+                raise ValueError('send_at must be a finite unix timestamp')
+            return float(send_at)
+        try:
+            parsed = datetime.fromisoformat(str(send_at).replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError('send_at must be a unix timestamp or ISO 8601 string')
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+
+    return None
+
+
+class MessageScheduler:
+    """Отложенные сообщения: задания хранятся в SQLite, таймер - min-heap на event loop бота.
+
+    В памяти держатся только пары (send_at, job_id), содержимое задания читается
+    из базы в момент отправки. Таймер всегда взведен только на ближайшее задание
+    (loop.call_at), поэтому ожидающие задания не сканируются. Вставка - O(log n),
+    отмена - удаление из базы с ленивой очисткой кучи.
+
+    Наступившие задания отправляются не более чем по SCHEDULER_CONCURRENCY
+    одновременно и удаляются из базы только после успешной отправки или
+    постоянной ошибки; после временной ошибки задание откладывается с
+    удвоением паузы, пока не исчерпано SCHEDULER_MAX_ATTEMPTS попыток.
+    """
+
+    def __init__(self, db_path: str, concurrency: int = SCHEDULER_CONCURRENCY,
+                 max_attempts: int = SCHEDULER_MAX_ATTEMPTS, retry_delay: float = SCHEDULER_RETRY_DELAY):
+        self.db_path = db_path
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._heap = []  # (send_at, job_id)
+        self._cancelled = 0  # отмененных записей, оставшихся в куче
+        self._due = deque()  # job_id наступивших заданий в очереди на отправку
+        self._active = set()  # job_id в очереди на отправку или отправляемые сейчас
+        self._workers = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sender: Optional[Callable[[Dict[str, Any]], Awaitable[Any]]] = None
+        self._is_retryable: Callable[[Exception], bool] = lambda e: False
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_at: Optional[float] = None
+        # Запросы к SQLite при отправке выполняются здесь, чтобы не блокировать event loop бота
+        self._db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='scheduler-db')
+
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # В режиме WAL этого достаточно для сохранности, а commit не ждет fsync под блокировкой
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS scheduled_messages ('
+            'job_id TEXT PRIMARY KEY, send_at REAL NOT NULL, '
+            'target TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, owner TEXT)'
+        )
+        self._migrate()
+        self._db.execute('CREATE INDEX IF NOT EXISTS scheduled_messages_send_at ON scheduled_messages (send_at)')
+        self._db.commit()
+        self._load()
+
+    def _migrate(self):
+        """Добавить колонки, которых нет в базе, созданной предыдущей версией"""
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(scheduled_messages)')}
+        if 'attempts' not in columns:
+            self._db.execute('ALTER TABLE scheduled_messages ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+        if 'owner' not in columns:
+            self._db.execute('ALTER TABLE scheduled_messages ADD COLUMN owner TEXT')
+
+    def _load(self):
+        """Загрузить время и id ожидающих заданий из базы в кучу"""
+        self._heap = self._db.execute('SELECT send_at, job_id FROM scheduled_messages').fetchall()
+        heapq.heapify(self._heap)
+        logger.info(f"Планировщик: загружено {len(self._heap)} отложенных сообщений из {self.db_path}")
+
+    def attach(self, loop: asyncio.AbstractEventLoop, sender: Callable[[Dict[str, Any]], Awaitable[Any]],
+               is_retryable: Optional[Callable[[Exception], bool]] = None):
+        """Привязать планировщик к event loop бота и функции отправки.
+
+        is_retryable решает, стоит ли повторить задание после ошибки отправки.
+        """
+        self._loop = loop
+        self._sender = sender
+        if is_retryable is not None:
+            self._is_retryable = is_retryable
+        loop.call_soon_threadsafe(self._rearm)
+
+    def schedule(self, target: str, send_at: float, text: Optional[str] = None,
+                 image_url: Optional[str] = None, file_path: Optional[str] = None,
+                 file_type: Optional[str] = None, owner: Optional[str] = None) -> Dict[str, Any]:
+        """Поставить сообщение в очередь. Потокобезопасно, вызывается из Flask потоков.
+
+        owner - имя API ключа, которому принадлежит задание.
+        """
+        job = {
+            'job_id': secrets.token_hex(8),
+            'send_at': send_at,
+            'target': target,
+            'created_at': time.time(),
+            'owner': owner,
+            'text': text,
+            'image_url': image_url,
+            'file_path': file_path,
+            'file_type': file_type,
+        }
+        payload = json.dumps({'text': text, 'image_url': image_url, 'file_path': file_path, 'file_type': file_type})
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO scheduled_messages (job_id, send_at, target, payload, created_at, owner) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (job['job_id'], send_at, target, payload, job['created_at'], owner)
+            )
+            self._db.commit()
+            heapq.heappush(self._heap, (send_at, job['job_id']))
+            is_next = self._heap[0][1] == job['job_id']
+
+        # Перевзводить таймер нужно только если новое задание стало ближайшим
+        if is_next and self._loop and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._rearm)
+        return self._public(job)
+
+    def cancel(self, job_id: str, owner: Optional[str] = None) -> bool:
+        """Отменить задание (только свое, если задан owner). Запись в куче удаляется лениво"""
+        with self._lock:
+            if owner is None:
+                cursor = self._db.execute('DELETE FROM scheduled_messages WHERE job_id = ?', (job_id,))
+            else:
+                cursor = self._db.execute('DELETE FROM scheduled_messages WHERE job_id = ? AND owner = ?',
+                                          (job_id, owner))
+            self._db.commit()
+            if not cursor.rowcount:
+                return False
+            if job_id not in self._active:
+                self._cancelled += 1
+            # Уплотнить кучу если в ней накопилось слишком много отмененных записей
+            if self._cancelled > 64 and 2 * self._cancelled > len(self._heap):
+                rows = self._db.execute('SELECT send_at, job_id FROM scheduled_messages').fetchall()
+                self._heap = [row for row in rows if row[1] not in self._active]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+        return True
+
+    def list_jobs(self, limit: int = 100, owner: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Вернуть ближайшие limit заданий по времени отправки (только свои, если задан owner)"""
+        query = 'SELECT job_id, send_at, target, payload, created_at, owner FROM scheduled_messages'
+        params = ()
+        if owner is not None:
+            query += ' WHERE owner = ?'
+            params = (owner,)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY send_at LIMIT ?', params + (limit,)).fetchall()
+        return [self._public(self._row_to_job(row)) for row in rows]
+
+    def pending_count(self, owner: Optional[str] = None) -> int:
+        with self._lock:
+            if owner is None:
+                return self._db.execute('SELECT COUNT(*) FROM scheduled_messages').fetchone()[0]
+            return self._db.execute('SELECT COUNT(*) FROM scheduled_messages WHERE owner = ?', (owner,)).fetchone()[0]
+
+    @staticmethod
+    def _row_to_job(row) -> Dict[str, Any]:
+        job_id, send_at, target, payload, created_at, owner = row
+        return {'job_id': job_id, 'send_at': send_at, 'target': target, 'created_at': created_at,
+                'owner': owner, **json.loads(payload)}
+
+    @staticmethod
+    def _public(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'job_id': job['job_id'],
+            'target': mask_target(job['target']),
+            'owner': job.get('owner'),
+            'send_at': job['send_at'],
+            'created_at': job['created_at'],
+            'has_text': bool(job.get('text')),
+            'has_image': bool(job.get('image_url')),
+            'has_file': bool(job.get('file_path')),
+        }
+
+    def _rearm(self):
+        """Взвести таймер на ближайшее задание. Выполняется только на event loop бота"""
+        with self._lock:
+            next_at = self._heap[0][0] if self._heap else None
+
+        if next_at == self._timer_at:
+            return
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._timer_at = next_at
+        if next_at is not None:
+            delay = max(0.0, next_at - time.time())
+            self._timer = self._loop.call_at(self._loop.time() + delay, self._fire)
+
+    def _fire(self):
+        """Поставить наступившие задания в очередь на отправку и перевзвести таймер"""
+        self._timer = None
+        self._timer_at = None
+        now = time.time()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, job_id = heapq.heappop(self._heap)
+                if job_id not in self._active:
+                    self._active.add(job_id)
+                    self._due.append(job_id)
+
+        # Очередь разбирают не более concurrency обработчиков, а не задача на каждое задание
+        while self._due and self._workers < self.concurrency:
+            self._workers += 1
+            self._loop.create_task(self._worker())
+        self._rearm()
+
+    async def _worker(self):
+        try:
+            while self._due:
+                job_id = self._due.popleft()
+                try:
+                    await self._dispatch(job_id)
+                except Exception as e:
+                    logger.error(f"Планировщик: ошибка обработки задания {job_id}: {e}", exc_info=True)
+                    with self._lock:
+                        self._active.discard(job_id)
+                # Дать event loop обработать остальное даже если задания завершаются без ожидания
+                await asyncio.sleep(0)
+        finally:
+            self._workers -= 1
+
+    async def _run_db(self, func, *args):
+        return await self._loop.run_in_executor(self._db_executor, func, *args)
+
+    def _load_job(self, job_id: str) -> Optional[tuple]:
+        with self._lock:
+            row = self._db.execute(
+                'SELECT job_id, send_at, target, payload, created_at, owner, attempts FROM scheduled_messages '
+                'WHERE job_id = ?', (job_id,)
+            ).fetchone()
+            if row is None:
+                # Задание отменено, пока ждало в куче
+                self._cancelled = max(0, self._cancelled - 1)
+                self._active.discard(job_id)
+        return row
+
+    def _reschedule(self, job_id: str, retry_at: float, attempts: int):
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE scheduled_messages SET send_at = ?, attempts = ? WHERE job_id = ?',
+                (retry_at, attempts, job_id)
+            )
+            self._db.commit()
+            self._active.discard(job_id)
+            if cursor.rowcount:
+                heapq.heappush(self._heap, (retry_at, job_id))
+
+    def _complete(self, job_id: str):
+        with self._lock:
+            self._db.execute('DELETE FROM scheduled_messages WHERE job_id = ?', (job_id,))
+            self._db.commit()
+            self._active.discard(job_id)
+
+    async def _dispatch(self, job_id: str):
+        """Отправить задание; удалить его после успеха или постоянной ошибки, иначе отложить"""
+        row = await self._run_db(self._load_job, job_id)
+        if row is None:
+            return
+        job = self._row_to_job(row[:6])
+        attempts = row[6] + 1
+
+        try:
+            await self._sender(job)
+            logger.info(f"Планировщик: задание {job_id} отправлено в {mask_target(job['target'])}")
+        except Exception as e:
+            if self._is_retryable(e) and attempts < self.max_attempts:
+                retry_at = time.time() + max(self.retry_delay * 2 ** (attempts - 1),
+                                             float(getattr(e, 'retry_after', 0) or 0))
+                await self._run_db(self._reschedule, job_id, retry_at, attempts)
+                logger.warning(f"Планировщик: задание {job_id} не отправлено (попытка {attempts}), "
+                               f"повтор через {retry_at - time.time():.0f} с: {e}")
+                self._rearm()
+                return
+            logger.error(f"Планировщик: ошибка отправки задания {job_id}, задание удалено: {e}", exc_info=True)
+
+        await self._run_db(self._complete, job_id)
+
+
+# Глобальный экземпляр планировщика
+message_scheduler = MessageScheduler(os.getenv('SCHEDULER_DB_PATH', 'logs/scheduled_messages.db'))
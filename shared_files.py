@@ -0,0 +1,135 @@
+import os
+import uuid
+import logging
+import mimetypes
+from typing import Optional, BinaryIO, List
+from telegram import InputFile
+
+logger = logging.getLogger(__name__)
+
+# Расширения, которые по умолчанию отправляются как фото, остальное - как документ
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+# Размер блока при потоковом чтении файла
+CHUNK_SIZE = 64 * 1024
+
+
+class SharedFiles:
+    """Доступ к файлам на общем томе для отправки по пути без base64.
+
+    Разрешены только обычные файлы внутри SHARED_FILES_DIR; если переменная
+    не задана, отправка по пути отключена.
+    """
+
+    def __init__(self):
+        base_dir = os.getenv('SHARED_FILES_DIR', '').strip()
+        self.base_dir = os.path.realpath(base_dir) if base_dir else None
+        if self.base_dir:
+            logger.info(f"Отправка файлов по пути разрешена из {self.base_dir}")
+
+    def is_enabled(self) -> bool:
+        return bool(self.base_dir)
+
+    def resolve(self, file_path: str) -> str:
+        """Проверить путь и вернуть абсолютный путь к файлу. ValueError если доступ запрещен"""
+        if not self.base_dir:
+            raise ValueError('file_path is disabled, set SHARED_FILES_DIR to enable it')
+        if not isinstance(file_path, str):
+            raise ValueError('file_path must be a string')
+        full_path = os.path.realpath(os.path.join(self.base_dir, file_path))
+        if os.path.commonpath([full_path, self.base_dir]) != self.base_dir:
+            raise ValueError('file_path must be inside the shared files directory')
+        if not os.path.isfile(full_path):
+            raise ValueError('file_path does not exist or is not a regular file')
+        return full_path
+
+
+def detect_file_type(file_path: str, file_type: Optional[str] = None) -> str:
+    """Определить способ отправки: 'photo' или 'document'"""
+    if file_type:
+        if not isinstance(file_type, str) or file_type not in ('photo', 'document'):
+            raise ValueError("file_type must be 'photo' or 'document'")
+        return file_type
+    return 'photo' if file_path.lower().endswith(PHOTO_EXTENSIONS) else 'document'
+
+
+def guess_mimetype(file_path: str) -> str:
+    return mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+
+
+class MultipartFileStream:
+    """Тело multipart/form-data, которое читает файл блоками при отправке.
+
+    requests сам собирает multipart целиком в памяти, а этот объект
+    отдает заголовки, поля и файл по частям и сообщает длину через __len__,
+    поэтому загрузка идет с Content-Length и без копии файла в памяти.
+    """
+
+    def __init__(self, fields: dict, field_name: str, file_path: str, filename: Optional[str] = None,
+                 mimetype: Optional[str] = None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        filename = (filename or os.path.basename(file_path)).replace('"', '%22')
+        mimetype = mimetype or guess_mimetype(file_path)
+
+        head = b''
+        for name, value in fields.items():
+            head += (
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            ).encode() + str(value).encode() + b'\r\n'
+        head += (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f'Content-Type: {mimetype}\r\n\r\n'
+        ).encode()
+        tail = f'\r\n--{self.boundary}--\r\n'.encode()
+
+        self._file = open(file_path, 'rb')
+        self._length = len(head) + os.fstat(self._file.fileno()).st_size + len(tail)
+        self._parts: List[object] = [head, self._file, tail]
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = CHUNK_SIZE) -> bytes:
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+        while self._parts:
+            part = self._parts[0]
+            if isinstance(part, bytes):
+                chunk, rest = part[:size], part[size:]
+                if rest:
+                    self._parts[0] = rest
+                else:
+                    self._parts.pop(0)
+                return chunk
+            chunk = part.read(size)
+            if chunk:
+                return chunk
+            self._parts.pop(0)
+        return b''
+
+    def close(self):
+        self._file.close()
+
+
+class StreamingInputFile(InputFile):
+    """InputFile, который передает httpx открытый файл вместо его содержимого.
+
+    Обычный InputFile в python-telegram-bot 20.x читает файл целиком,
+    а httpx умеет отправлять файловый объект блоками.
+    """
+
+    __slots__ = ('file',)
+
+    def __init__(self, file: BinaryIO, filename: str):
+        super().__init__(b'', filename=filename)
+        self.file = file
+
+    @property
+    def field_tuple(self):
+        return self.filename, self.file, self.mimetype
+
+
+# Глобальный экземпляр доступа к общему тому
+shared_files = SharedFiles()
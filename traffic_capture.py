@@ -0,0 +1,129 @@
+import os
+import hmac
+import json
+import math
+import time
+import hashlib
+import secrets
+import logging
+import threading
+from typing import Optional, Dict, Any, Mapping
+
+logger = logging.getLogger(__name__)
+
+# Числовые опции запроса, которые сохраняются как есть
+NUMERIC_OPTIONS = ('delay', 'coalesce_ms')
+
+
+def as_number(value: Any) -> Optional[float]:
+    """Конечное число из значения поля или заголовка (None, если его нельзя разобрать)"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return number if math.isfinite(number) else None
+
+
+def classify_image(image_url: Optional[str]) -> Optional[str]:
+    """Вид изображения в запросе: url, data_url или base64"""
+    if not image_url:
+        return None
+    if image_url.startswith('data:image/'):
+        return 'data_url'
+    if image_url.startswith('http'):
+        return 'url'
+    return 'base64'
+
+
+def image_size(image_url: Optional[str], kind: Optional[str]) -> int:
+    """Примерный размер изображения в байтах без декодирования base64"""
+    if kind == 'data_url':
+        return len(image_url.split(',', 1)[-1]) * 3 // 4
+    if kind == 'base64':
+        return len(image_url) * 3 // 4
+    return 0
+
+
+class TrafficRecorder:
+    """Запись формы запросов к /send_message и /send_to_channel в компактный JSONL.
+
+    Содержимое не сохраняется: получатели заменяются коротким HMAC с секретом
+    записи, текст и изображения - длиной и видом, токены не пишутся вовсе.
+    Секрет берется из TRAFFIC_CAPTURE_SECRET или генерируется при запуске и
+    не сохраняется, поэтому числовой chat_id нельзя подобрать перебором по хэшу.
+    Включается переменной TRAFFIC_CAPTURE_PATH; запись ведется построчно под блокировкой.
+    """
+
+    def __init__(self, path: Optional[str], secret: Optional[str] = None):
+        self.path = path
+        self._secret = secret.encode() if secret else secrets.token_bytes(32)
+        self._file = None
+        self._lock = threading.Lock()
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(path, 'a', encoding='utf-8', buffering=1)
+            logger.info(f"Запись трафика включена: {path}")
+
+    def is_enabled(self) -> bool:
+        return self._file is not None
+
+    def _hash(self, value: str) -> str:
+        return hmac.new(self._secret, value.encode(), hashlib.sha256).hexdigest()[:12]
+
+    def describe(self, endpoint: str, data: Optional[Dict[str, Any]], target_field: str,
+                 headers: Optional[Mapping[str, str]] = None, started: Optional[float] = None) -> Dict[str, Any]:
+        """Обезличенное описание запроса.
+
+        Дедлайн сохраняется так же, как его разбирает parse_deadline: timeout - самый
+        короткий из поля и заголовка X-Request-Timeout, deadline_in - самый ранний из
+        поля deadline и заголовка X-Request-Deadline в секундах от начала запроса.
+        """
+        data = data if isinstance(data, dict) else {}
+        headers = headers or {}
+        started = time.time() if started is None else started
+        target = str(data.get(target_field) or '')
+        text = data.get('text') or ''
+        image_url = data.get('image_url')
+        kind = classify_image(image_url) if isinstance(image_url, str) else None
+        record = {
+            'ep': endpoint,
+            'dst': 'dc' if target.startswith('https://discord.com/api/webhooks/') else 'tg',
+            'tgt': self._hash(target) if target else None,
+            'txt': len(text) if isinstance(text, str) else 0,
+            'img': kind,
+            'img_b': image_size(image_url, kind),
+        }
+        if data.get('file_path'):
+            record['img'] = 'file'
+            if isinstance(data.get('file_type'), str):
+                record['file_type'] = data['file_type']
+        opts = {name: data[name] for name in NUMERIC_OPTIONS if isinstance(data.get(name), (int, float))}
+        timeouts = [t for t in (as_number(data.get('timeout')), as_number(headers.get('X-Request-Timeout')))
+                    if t is not None]
+        if timeouts:
+            opts['timeout'] = min(timeouts)
+        deadlines = [d for d in (as_number(data.get('deadline')), as_number(headers.get('X-Request-Deadline')))
+                     if d is not None]
+        if deadlines:
+            opts['deadline_in'] = round(min(deadlines) - started, 3)
+        if data.get('send_at') is not None:
+            opts['send_at'] = True
+        if opts:
+            record['opts'] = opts
+        return record
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+
+
+# Глобальный экземпляр записи трафика
+traffic_recorder = TrafficRecorder(
+    os.getenv('TRAFFIC_CAPTURE_PATH', '').strip() or None,
+    secret=os.getenv('TRAFFIC_CAPTURE_SECRET', '').strip() or None,
+)
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Any, List
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes
+
+logger = logging.getLogger(__name__)
+
+# Сколько обновлений запрашивать за один вызов getUpdates при догоне
+FETCH_LIMIT = 100
+# Группа обработчика track_update: после всех обработчиков бота
+TRACK_GROUP = 1000
+
+
+class UpdateBacklog:
+    """Сохранение offset обработанных обновлений и догон очереди после перезапуска.
+
+    Перед запуском polling накопившиеся обновления забираются пачками и
+    фильтруются политикой из переменных окружения:
+    - CATCHUP_MAX_AGE: отбросить сообщения старше N секунд (0 - не отбрасывать)
+    - CATCHUP_COLLAPSE_FORWARDS: из нескольких пересланных сообщений одного чата ответить только на последнее
+    - CATCHUP_CONCURRENCY: сколько обновлений очереди обрабатывать параллельно
+    """
+
+    def __init__(self, offset_path: str, max_age: float = 0, collapse_forwards: bool = False,
+                 concurrency: int = 1, save_interval: float = 5.0):
+        self.offset_path = offset_path
+        self.max_age = max_age
+        self.collapse_forwards = collapse_forwards
+        self.concurrency = max(1, concurrency)
+        self.save_interval = save_interval
+        self.last_update_id = self._load()
+        self._saved_update_id = self.last_update_id
+        self._saved_at = 0.0
+        # save вызывается и из потока бота, и из atexit в главном потоке
+        self._save_lock = threading.Lock()
+
+    def _load(self) -> int:
+        try:
+            with open(self.offset_path, encoding='utf-8') as f:
+                return int(json.load(f)['last_update_id'])
+        except FileNotFoundError:
+            return 0
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Не удалось прочитать offset из {self.offset_path}: {e}")
+            return 0
+
+    def save(self, force: bool = False):
+        """Записать последний обработанный update_id (не чаще save_interval без force).
+
+        Вызывается после каждого обновления, раз в секунду из цикла бота
+        (чтобы записать хвост после затишья) и из atexit при остановке процесса.
+        """
+        with self._save_lock:
+            last_update_id = self.last_update_id
+            if last_update_id == self._saved_update_id:
+                return
+            if not force and time.monotonic() - self._saved_at < self.save_interval:
+                return
+            directory = os.path.dirname(self.offset_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = self.offset_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'last_update_id': last_update_id, 'saved_at': time.time()}, f)
+            os.replace(tmp_path, self.offset_path)
+            self._saved_update_id = last_update_id
+            self._saved_at = time.monotonic()
+
+    async def track_update(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Обработчик группы TRACK_GROUP: запомнить update_id обновления после всех остальных обработчиков"""
+        if isinstance(update, Update) and update.update_id > self.last_update_id:
+            self.last_update_id = update.update_id
+            self.save()
+
+    def _check_stale(self, first_page: List[Update]):
+        """Сбросить сохраненный offset, если он не относится к текущей очереди Telegram.
+
+        Обработанное, но не подтвержденное обновление остается в очереди, поэтому
+        при верном offset самое новое обновление первой страницы не меньше него.
+        Если вся страница ниже, значит update_id начались заново (больше недели
+        без обновлений) или сменился токен, и offset отбросил бы всю очередь.
+        """
+        if not first_page or not self.last_update_id or first_page[-1].update_id >= self.last_update_id:
+            return
+        logger.warning(
+            f"Сохраненный update_id {self.last_update_id} новее очереди Telegram "
+            f"(последний ожидающий {first_page[-1].update_id}), offset сброшен"
+        )
+        self.last_update_id = 0
+        self.save(force=True)
+
+    def _filter(self, updates: List[Update]) -> Dict[str, Any]:
+        """Применить политику догона, вернуть оставленные обновления и счетчики"""
+        now = datetime.now(timezone.utc)
+        kept = []
+        stale = 0
+        for update in updates:
+            if update.update_id <= self.last_update_id:
+                # Уже обработано до перезапуска, но не подтверждено в Telegram
+                stale += 1
+                continue
+            message = update.effective_message
+            if self.max_age and message and message.date and (now - message.date).total_seconds() > self.max_age:
+                stale += 1
+                continue
+            kept.append(update)
+
+        collapsed = 0
+        if self.collapse_forwards:
+            last_forward: Dict[int, int] = {}
+            for update in kept:
+                message = update.effective_message
+                if message and message.forward_origin and update.effective_chat:
+                    last_forward[update.effective_chat.id] = update.update_id
+            result = []
+            for update in kept:
+                message = update.effective_message
+                if (message and message.forward_origin and update.effective_chat
+                        and last_forward[update.effective_chat.id] != update.update_id):
+                    collapsed += 1
+                    continue
+                result.append(update)
+            kept = result
+
+        return {'kept': kept, 'stale': stale, 'collapsed': collapsed}
+
+    async def catch_up(self, application: Application) -> Dict[str, Any]:
+        """Забрать накопившиеся обновления, отфильтровать и обработать до старта polling.
+
+        Первая страница запрашивается без offset, чтобы ничего не подтвердить до
+        проверки сохраненного update_id. Последний вызов getUpdates с offset после
+        самого нового обновления подтверждает всю очередь, поэтому Updater начнет
+        уже с новых обновлений.
+        """
+        started = time.monotonic()
+        bot = application.bot
+        offset = None
+        updates: List[Update] = []
+        while True:
+            batch = await bot.get_updates(offset=offset, limit=FETCH_LIMIT, timeout=0,
+                                          allowed_updates=Update.ALL_TYPES)
+            if offset is None:
+                self._check_stale(batch)
+            if not batch:
+                break
+            updates.extend(batch)
+            offset = batch[-1].update_id + 1
+            if len(batch) < FETCH_LIMIT:
+                break
+        if offset is not None:
+            # Подтвердить обработанную очередь в Telegram
+            await bot.get_updates(offset=offset, limit=1, timeout=0, allowed_updates=Update.ALL_TYPES)
+
+        filtered = self._filter(updates)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def process(update: Update):
+            async with semaphore:
+                await application.process_update(update)
+
+        await asyncio.gather(*(process(update) for update in filtered['kept']))
+        if updates:
+            self.last_update_id = max(self.last_update_id, updates[-1].update_id)
+        self.save(force=True)
+
+        report = {
+            'fetched': len(updates),
+            'processed': len(filtered['kept']),
+            'dropped_stale': filtered['stale'],
+            'collapsed_forwards': filtered['collapsed'],
+            'seconds': round(time.monotonic() - started, 3),
+        }
+        logger.info(
+            f"Догон очереди обновлений: получено {report['fetched']}, обработано {report['processed']}, "
+            f"отброшено устаревших {report['dropped_stale']}, свернуто пересылок {report['collapsed_forwards']} "
+            f"за {report['seconds']} с"
+        )
+        return report
+
+
+# Глобальный экземпляр догона очереди обновлений
+update_backlog = UpdateBacklog(
+    offset_path=os.getenv('UPDATE_OFFSET_PATH', 'logs/update_offset.json'),
+    max_age=float(os.getenv('CATCHUP_MAX_AGE', '0')),
+    collapse_forwards=os.getenv('CATCHUP_COLLAPSE_FORWARDS', '').strip().lower() in ('1', 'true', 'yes'),
+    concurrency=int(os.getenv('CATCHUP_CONCURRENCY', '1')),
+)